@@ -16,20 +16,23 @@ def unit_test_spec(event):
     if x == 6: assert y == 8
 
 @rv.monitor(fib=fib.fib)
-@rv.spec(when=rv.POST)
+@rv.spec(when=rv.POST, history_size=rv.INFINITE_HISTORY_SIZE,
+        index=lambda call: call.inputs[0])
 def old_data_spec(event):
     x = event.fn.fib.inputs[0]
     y = event.fn.fib.result
-
-    data = [(x.inputs[0], x.result) for x in event.fn.fib.history]
-
-    for x2, y2 in data:
-        if x < x2:
-            assert y <= y2
-        elif x > x2:
-            assert y >= y2
-        else:
-            assert y == y2
+    history = event.fn.fib.history
+
+    # the history is kept monotonic, so it is enough to compare with the
+    # nearest calls
+    below = history.nearest_below(x)
+    if below:
+        assert y >= below.result
+    above = history.nearest_above(x)
+    if above:
+        assert y <= above.result
+    for same in history.range(x, x):
+        assert y == same.result
 
 @rv.monitor(fib=fib.fib)
 @rv.spec(level=rv.DEBUG)
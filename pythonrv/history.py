@@ -0,0 +1,977 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import uuid
+import types
+import atexit
+import weakref
+import logging
+import array
+import bisect
+import threading
+import collections
+
+from .dotdict import dotdict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# a clock that never goes backwards, where there is one
+monotonic = getattr(time, 'monotonic', time.time)
+
+def _check_limits(capacity, window, max_bytes=None):
+    if capacity is not None and capacity < 1:
+        raise ValueError("The capacity of a history must be at least 1, not %d" % capacity)
+    if window is not None and window <= 0:
+        raise ValueError("The window of a history must be positive, not %s" % window)
+    if max_bytes is not None and max_bytes <= 0:
+        raise ValueError("The byte budget of a history must be positive, not %s" % max_bytes)
+
+# shared by everything that refers to them, and not counted by estimate_size
+_UNSIZED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+        types.BuiltinFunctionType, types.MethodType)
+
+def estimate_size(obj):
+    """
+    Estimates the number of bytes taken by obj and the objects it refers to,
+    through containers and instance attributes. Every object is counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _UNSIZED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 64)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        elif isinstance(getattr(obj, '__dict__', None), dict):
+            stack.append(obj.__dict__)
+    return size
+
+class SortedIndex(object):
+    """
+    The keys of the entries of a history, by their numbers, kept sorted. key is
+    called with an entry to get its key.
+
+    Keys that are appended in order, such as timestamps, and entries that are
+    evicted with the smallest key take amortized O(1) time; others take O(n).
+    """
+    def __init__(self, key):
+        self.key = key
+        # (key, number), sorted from _start on; the ones before it have been
+        # removed, and are dropped once they are half of the list
+        self._sorted = []
+        self._start = 0
+        self._keys = {}
+
+    def key_of(self, entry):
+        return self.key(entry)
+
+    def add(self, number, key):
+        item = (key, number)
+        if len(self._sorted) == self._start or item >= self._sorted[-1]:
+            self._sorted.append(item)
+        else:
+            bisect.insort(self._sorted, item, self._start)
+        self._keys[number] = key
+
+    def remove(self, number):
+        key = self._keys.pop(number)
+        i = bisect.bisect_left(self._sorted, (key, number), self._start)
+        if i > self._start:
+            del self._sorted[i]
+            return
+        self._start += 1
+        if self._start * 2 > len(self._sorted):
+            del self._sorted[:self._start]
+            self._start = 0
+
+    def clear(self):
+        self._sorted = []
+        self._start = 0
+        self._keys = {}
+
+    def nearest_below(self, key):
+        i = bisect.bisect_left(self._sorted, (key,), self._start)
+        return self._sorted[i-1][1] if i > self._start else None
+
+    def nearest_above(self, key):
+        i = bisect.bisect_right(self._sorted, (key, float('inf')), self._start)
+        return self._sorted[i][1] if i < len(self._sorted) else None
+
+    def range(self, lo, hi):
+        start = bisect.bisect_left(self._sorted, (lo,), self._start)
+        end = bisect.bisect_right(self._sorted, (hi, float('inf')), self._start)
+        return [number for key, number in self._sorted[start:end]]
+
+class HashIndex(object):
+    """
+    The numbers of the entries of a history, by their keys. key is called with
+    an entry to get its key, which must be hashable.
+    """
+    def __init__(self, key):
+        self.key = key
+        # key -> the numbers of the entries with the key, oldest first
+        self._numbers = {}
+        self._keys = {}
+
+    def key_of(self, entry):
+        key = self.key(entry)
+        # an unhashable key fails here, before anything is added
+        hash(key)
+        return key
+
+    def add(self, number, key):
+        self._numbers.setdefault(key, collections.deque()).append(number)
+        self._keys[number] = key
+
+    def remove(self, number):
+        # entries are evicted oldest first, so number is the oldest with its key
+        key = self._keys.pop(number)
+        numbers = self._numbers[key]
+        numbers.popleft()
+        if not numbers:
+            del self._numbers[key]
+
+    def clear(self):
+        self._numbers = {}
+        self._keys = {}
+
+    def lookup(self, key, skip=0):
+        numbers = self._numbers.get(key)
+        if not numbers or skip >= len(numbers):
+            return None
+        return numbers[-1 - skip]
+
+class _IndexedHistory(object):
+    """
+    The queries of histories with indexes of their entries: index, a
+    SortedIndex, and key_index, a HashIndex.
+    """
+    index = None
+    key_index = None
+
+    def _setup_indexes(self, index, key):
+        self.index = SortedIndex(index) if index else None
+        self.key_index = HashIndex(key) if key else None
+
+    def _index_keys(self, entry):
+        # the keys of entry, computed before the history is changed, so that a
+        # failing key function leaves it as it was
+        return (self.index.key_of(entry) if self.index else None,
+                self.key_index.key_of(entry) if self.key_index else None)
+
+    def _indexed(self, number, keys):
+        index_key, key = keys
+        if self.index:
+            self.index.add(number, index_key)
+        if self.key_index:
+            self.key_index.add(number, key)
+
+    def _unindexed(self, number):
+        if self.index:
+            self.index.remove(number)
+        if self.key_index:
+            self.key_index.remove(number)
+
+    def _clear_indexes(self):
+        if self.index:
+            self.index.clear()
+        if self.key_index:
+            self.key_index.clear()
+
+    def lookup(self, key, skip=0):
+        """
+        Returns the newest entry with the key key, or None. With skip, the skip
+        newest entries with the key are skipped, so that skip=1 gives the one
+        before the newest. Takes O(1) time.
+        """
+        if not self.key_index:
+            raise ValueError("The history has no key")
+        number = self.key_index.lookup(key, skip)
+        return None if number is None else self.entry(number)
+
+    def _check_index(self):
+        if not self.index:
+            raise ValueError("The history has no index")
+
+    def nearest_below(self, key):
+        """
+        Returns the entry with the greatest key below key (the newest one, if
+        several have that key), or None. Takes O(log n) time.
+        """
+        self._check_index()
+        number = self.index.nearest_below(key)
+        return None if number is None else self.entry(number)
+
+    def nearest_above(self, key):
+        """
+        Returns the entry with the smallest key above key (the oldest one, if
+        several have that key), or None. Takes O(log n) time.
+        """
+        self._check_index()
+        number = self.index.nearest_above(key)
+        return None if number is None else self.entry(number)
+
+    def range(self, lo, hi):
+        """
+        Returns the entries with keys from lo to hi, both inclusive, ordered by
+        their keys. Takes O(log n) time, plus the number of entries returned.
+        """
+        self._check_index()
+        return [self.entry(number) for number in self.index.range(lo, hi)]
+
+class History(_IndexedHistory):
+    """
+    The history of a specification or a monitor: a sequence of at most
+    capacity entries, oldest first. Appending to a full history evicts its
+    oldest entry in constant time, however large the capacity. A capacity of
+    None means that the history is never truncated by size.
+
+    With a window, in seconds, entries older than the window (relative to the
+    newest entry) are evicted as well when appending.
+
+    With max_bytes, the oldest entries are evicted when appending to keep the
+    total size of the entries, as estimated by sizeof when they are appended,
+    within max_bytes. The newest entry is always kept.
+
+    With an index, a function returning the key of an entry, the entries are
+    kept sorted by their keys as well, for the queries nearest_below,
+    nearest_above and range. With a key, a function returning a hashable key of
+    an entry, the newest entry with a key can be looked up.
+
+    Every appended entry is numbered, from 0 and up, and can be looked up by
+    its number for as long as it is in the history.
+    """
+    def __init__(self, capacity=None, window=None, index=None, key=None,
+            max_bytes=None, sizeof=estimate_size):
+        _check_limits(capacity, window, max_bytes)
+        self.capacity = capacity
+        self.window = window
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._setup_indexes(index, key)
+        # the sizes of the entries, oldest first, when there is a byte budget
+        self._sizes = collections.deque()
+        self._bytes = 0
+        # a ring of entries, and their timestamps; _start is the index of the
+        # oldest entry, and _len the number of entries
+        self._items = []
+        self._times = []
+        self._start = 0
+        self._len = 0
+        # the number of entries ever appended
+        self.appended = 0
+
+    def append(self, entry, timestamp=None):
+        """
+        Appends entry as the newest entry, and returns the list of entries it
+        evicted, oldest first. timestamp is the time of the entry, by the
+        monotonic clock, and defaults to now.
+        """
+        if timestamp is None and self.window is not None:
+            timestamp = monotonic()
+        keys = self._index_keys(entry)
+        if self.max_bytes is not None:
+            size = self.sizeof(entry)
+        evicted = []
+        if self.window is not None:
+            while self._len and timestamp - self._times[self._start] > self.window:
+                evicted.append(self.popleft())
+        if self.capacity is not None and self._len == self.capacity:
+            evicted.append(self.popleft())
+        if self.max_bytes is not None:
+            while self._len and self._bytes + size > self.max_bytes:
+                evicted.append(self.popleft())
+        # the sorted index can still fail to compare the key, so the entry is
+        # only pushed once it is indexed
+        self._indexed(self.appended, keys)
+        if self.max_bytes is not None:
+            self._sizes.append(size)
+            self._bytes += size
+        self._push(entry, timestamp)
+        self.appended += 1
+        return evicted
+
+    def _push(self, entry, timestamp):
+        size = len(self._items)
+        if self._len < size:
+            i = (self._start + self._len) % size
+            self._items[i] = entry
+            self._times[i] = timestamp
+        else:
+            if self._start:
+                # the ring is full, but may grow; unwrap it first
+                self._items = self._items[self._start:] + self._items[:self._start]
+                self._times = self._times[self._start:] + self._times[:self._start]
+                self._start = 0
+            self._items.append(entry)
+            self._times.append(timestamp)
+        self._len += 1
+
+    def popleft(self):
+        """
+        Evicts and returns the oldest entry.
+        """
+        if not self._len:
+            raise IndexError("pop from an empty history")
+        self._unindexed(self.appended - self._len)
+        if self.max_bytes is not None:
+            self._bytes -= self._sizes.popleft()
+        i = self._start
+        entry = self._items[i]
+        self._items[i] = self._times[i] = None
+        self._start = (i + 1) % len(self._items)
+        self._len -= 1
+        return entry
+
+    def entry(self, number):
+        """
+        Returns the entry that was appended as number number, or None if it
+        has been evicted (or not appended yet).
+        """
+        first = self.appended - self._len
+        if first <= number < self.appended:
+            return self[number - first]
+        return None
+
+    def timestamp(self, index):
+        """
+        Returns the timestamp of the entry at index.
+        """
+        return self._times[self._physical(index)]
+
+    def remeasure(self, number):
+        """
+        Measures the entry that was appended as number number again, with
+        sizeof, after it has changed in place. Only histories with a byte
+        budget keep the sizes measured when appending.
+        """
+        if self.max_bytes is None:
+            return
+        i = number - (self.appended - self._len)
+        if 0 <= i < self._len:
+            size = self.sizeof(self._items[self._physical(i)])
+            self._bytes += size - self._sizes[i]
+            self._sizes[i] = size
+
+    def resize(self, capacity):
+        """
+        Changes the capacity of the history, and returns the list of entries
+        evicted to fit into it, oldest first.
+        """
+        _check_limits(capacity, None)
+        evicted = []
+        while capacity is not None and self._len > capacity:
+            evicted.append(self.popleft())
+        self.capacity = capacity
+        return evicted
+
+    def retained_bytes(self):
+        """
+        Returns the total size of the entries, as estimated by sizeof.
+        """
+        if self.max_bytes is not None:
+            return self._bytes
+        return sum(self.sizeof(entry) for entry in self)
+
+    def clear(self):
+        self._clear_indexes()
+        self._sizes.clear()
+        self._bytes = 0
+        self._items = []
+        self._times = []
+        self._start = 0
+        self._len = 0
+
+    def _physical(self, index):
+        n = self._len
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("history index out of range")
+        return (self._start + index) % len(self._items)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self._items[self._physical(index)]
+
+    def __iter__(self):
+        items = self._items
+        start = self._start
+        size = len(items)
+        for i in xrange(self._len):
+            yield items[(start + i) % size]
+
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __repr__(self):
+        return "History(%s, capacity=%s, window=%s)" % (list(self), self.capacity, self.window)
+
+class HistoryWindow(object):
+    """
+    A read-only view of the newest entries of a history: at most size of them
+    (or all, if size is None), appended as number start or later. The entries
+    are passed through wrap, if given, when read.
+
+    Several windows can share one history, each with its own size, while the
+    history keeps every entry once. If the history is appended to while it is
+    read, lock must be the lock held by the ones appending; the entries read
+    are the ones in the window when it was read, even if they are evicted
+    before they are returned.
+    """
+    def __init__(self, history, size=None, start=0, wrap=None, sizeof=estimate_size, lock=None):
+        self.history = history
+        self.size = size
+        self.start = start
+        self.wrap = wrap
+        self.sizeof = sizeof
+        self.lock = lock or threading.Lock()
+
+    def _first(self):
+        history = self.history
+        first = max(self.start, history.appended - len(history))
+        if self.size is not None:
+            first = max(first, history.appended - self.size)
+        return first
+
+    def _entries(self, indices=slice(None)):
+        # the entries of the window, or the ones at the slice indices of it, as
+        # they are at this moment
+        history = self.history
+        with self.lock:
+            first = self._first()
+            numbers = xrange(*indices.indices(max(0, history.appended - first)))
+            return [history.entry(first + i) for i in numbers]
+
+    @property
+    def appended(self):
+        return self.history.appended
+
+    def entry(self, number):
+        """
+        Returns the entry that was appended as number number, or None if it is
+        outside the window.
+        """
+        with self.lock:
+            if not self._first() <= number < self.history.appended:
+                return None
+            entry = self.history.entry(number)
+        return self._wrapped(entry)
+
+    def retained_bytes(self):
+        """
+        Returns the total size of the entries of the history in the window, as
+        estimated by sizeof.
+        """
+        return sum(self.sizeof(entry) for entry in self._entries())
+
+    def _wrapped(self, entry):
+        if self.wrap is None:
+            return entry
+        return self.wrap(entry)
+
+    def __len__(self):
+        with self.lock:
+            return max(0, self.history.appended - self._first())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._wrapped(entry) for entry in self._entries(index)]
+        entries = self._entries(slice(index, index + 1 or None))
+        if not entries:
+            raise IndexError("history index out of range")
+        return self._wrapped(entries[0])
+
+    def __iter__(self):
+        for entry in self._entries():
+            yield self._wrapped(entry)
+
+    def __reversed__(self):
+        for entry in reversed(self._entries()):
+            yield self._wrapped(entry)
+
+    def __repr__(self):
+        return "HistoryWindow(%s, size=%s)" % (list(self), self.size)
+
+class Column(object):
+    """
+    The values of a column of a ColumnarHistory, oldest first, as they were
+    when the column was taken. The aggregates are computed in C, by NumPy if
+    it is installed, and else by the builtins over an array.array.
+    """
+    def __init__(self, values):
+        # a private copy of the values of the history
+        self.values = numpy.frombuffer(values, numpy.float64) if numpy else values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def max(self):
+        return max(self.values) if not numpy else self.values.max()
+
+    def min(self):
+        return min(self.values) if not numpy else self.values.min()
+
+    def sum(self):
+        return sum(self.values) if not numpy else self.values.sum()
+
+    def mean(self):
+        if not len(self.values):
+            return None
+        return self.sum() / float(len(self.values))
+
+    def is_sorted(self):
+        """
+        Returns whether the values never decrease.
+        """
+        if numpy:
+            return bool((numpy.diff(self.values) >= 0).all())
+        # sorting a sorted array takes linear time
+        return array.array('d', sorted(self.values)) == self.values
+
+    def __repr__(self):
+        return "Column(%s)" % list(self.values)
+
+class ColumnarHistory(object):
+    """
+    A history, as History, that only keeps some numeric values of its entries,
+    in columns backed by arrays of doubles. columns maps the name of every
+    column to the function computing its value from an entry; values that are
+    None, or not numbers, are kept as NaN.
+
+    Reading an entry gives a dotdict of its values. history.column(name) gives
+    all values of a column, with aggregates such as max and is_sorted.
+    """
+    def __init__(self, columns, capacity=None, window=None):
+        _check_limits(capacity, window)
+        self.columns = dict(columns)
+        self.capacity = capacity
+        self.window = window
+        self._values = dict((name, array.array('d')) for name in self.columns)
+        self._times = array.array('d')
+        # the index of the oldest entry in the arrays; evicted entries are
+        # dropped from the arrays in bulk
+        self._start = 0
+        self.appended = 0
+
+    def append(self, entry, timestamp=None):
+        """
+        Appends the values of entry, and returns the number of entries it
+        evicted.
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        # all values are computed before any column is appended to, so that
+        # the columns stay aligned if a column function fails
+        values = [(name, _column_value(func(entry))) for name, func in self.columns.items()]
+        evicted = 0
+        if self.window is not None:
+            while len(self) and timestamp - self._times[self._start] > self.window:
+                self.popleft()
+                evicted += 1
+        if self.capacity is not None and len(self) == self.capacity:
+            self.popleft()
+            evicted += 1
+        for name, value in values:
+            self._values[name].append(value)
+        self._times.append(timestamp)
+        self.appended += 1
+        return evicted
+
+    def popleft(self):
+        """
+        Evicts the oldest entry.
+        """
+        if not len(self):
+            raise IndexError("pop from an empty history")
+        self._start += 1
+        if self._start >= 1024 and 2 * self._start >= len(self._times):
+            for values in self._values.values():
+                del values[:self._start]
+            del self._times[:self._start]
+            self._start = 0
+
+    def column(self, name):
+        """
+        Returns the values of the column name, oldest first.
+        """
+        if name not in self._values:
+            raise ValueError("The history has no column %s" % name)
+        return Column(self._values[name][self._start:])
+
+    def entry(self, number):
+        """
+        Returns the values of the entry that was appended as number number, or
+        None if it has been evicted.
+        """
+        first = self.appended - len(self)
+        if first <= number < self.appended:
+            return self[number - first]
+        return None
+
+    def timestamp(self, index):
+        return self._times[self._physical(index)]
+
+    def retained_bytes(self):
+        """
+        Returns the size of the arrays of the history.
+        """
+        arrays = list(self._values.values()) + [self._times]
+        return sum(sys.getsizeof(values) for values in arrays)
+
+    def clear(self):
+        self._values = dict((name, array.array('d')) for name in self.columns)
+        self._times = array.array('d')
+        self._start = 0
+
+    def _physical(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("history index out of range")
+        return self._start + index
+
+    def __len__(self):
+        return len(self._times) - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        i = self._physical(index)
+        return dotdict(**dict((name, values[i]) for name, values in self._values.items()))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __repr__(self):
+        return "ColumnarHistory(%s, capacity=%s, window=%s)" % (sorted(self.columns), self.capacity, self.window)
+
+def _column_value(value):
+    if value is None or isinstance(value, basestring):
+        return _NAN
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return _NAN
+
+_NAN = float('nan')
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _connect(path):
+    # one connection per file and process, shared by all the histories of the
+    # process. the histories are locked by their users, like the in-memory
+    # ones. connections aren't used across a fork, so a child opens its own
+    key = (os.getpid(), path)
+    with _connections_lock:
+        if key not in _connections:
+            connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            # the file can be shared by several processes. with a write-ahead
+            # log they don't block each other's readers, and the file stays
+            # consistent when one of them crashes
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            _connections[key] = connection
+        return _connections[key]
+
+# the tables of the live disk histories, by a weak reference to their history,
+# with the connection and the process they were created by
+_tables = {}
+
+def _drop_table(ref):
+    db, table, pid = _tables.pop(ref)
+    # a forked child doesn't drop the tables of its parent
+    if pid == os.getpid():
+        try:
+            db.execute("DROP TABLE IF EXISTS %s" % table)
+        except sqlite3.Error:
+            pass
+
+@atexit.register
+def _drop_tables():
+    for ref in list(_tables):
+        _drop_table(ref)
+
+class DiskHistory(_IndexedHistory):
+    """
+    A history, as History, that keeps its hot_size newest entries in memory and
+    the older ones pickled in a table of the SQLite database in the file path.
+    Entries are read back from the file when they are accessed, and iterating
+    over the history streams them from it. loaded, if given, is called with
+    every entry read back.
+
+    Every history has a table of its own, which is dropped when the history is
+    freed, so the file can be shared by several histories and processes. A
+    forked child continues with a copy of the entries on disk.
+
+    Entries that can't be pickled are kept in memory, and so are the entries
+    that can't be written to the file; failing to write never fails an append.
+    """
+    def __init__(self, path, hot_size=100, capacity=None, window=None, loaded=None,
+            index=None, key=None, sizeof=estimate_size):
+        if sqlite3 is None:
+            raise ValueError("Disk histories require the sqlite3 module")
+        _check_limits(capacity, window)
+        self._hot = History(hot_size, sizeof=sizeof)
+        self.capacity = capacity
+        self.window = window
+        # the indexes are kept in memory
+        self._setup_indexes(index, key)
+        self.appended = 0
+        self._loaded = loaded
+        # the entries past the hot ones that aren't in the file, by number
+        self._in_memory = {}
+        # the entries past the hot ones are numbered _disk_first and up, and
+        # their timestamps are kept in memory
+        self._disk_first = 0
+        self._disk_count = 0
+        self._disk_times = collections.deque()
+
+        self._path = path
+        self._pid = None
+        self._db = None
+        self._table = None
+        self._open()
+
+    def _open(self):
+        # creates the table of the history in this process, copying the
+        # entries of the table it was forked with, if any
+        old = self._table
+        self._pid = os.getpid()
+        self._db = self._table = None
+        try:
+            db = _connect(self._path)
+            table = "history_%s" % uuid.uuid4().hex
+            db.execute("CREATE TABLE %s (number INTEGER PRIMARY KEY, data BLOB)" % table)
+            _tables[weakref.ref(self, _drop_table)] = (db, table, self._pid)
+            if old is not None:
+                db.execute("INSERT INTO %s SELECT number, data FROM %s WHERE number >= ? "
+                        "AND number < ?" % (table, old),
+                        (self._disk_first, self._disk_first + self._disk_count))
+        except sqlite3.Error as e:
+            self._failed(e)
+            # the entries in the file of the parent are lost, and so are the
+            # ones kept in memory between them
+            while self._disk_count:
+                self.popleft()
+            return
+        self._db = db
+        self._table = table
+        # the parent may have evicted its oldest entries since the fork
+        while self._disk_count and self._disk_first not in self._in_memory and \
+                self._select(self._disk_first, self._disk_first + 1) == []:
+            self.popleft()
+
+    def _database(self):
+        # the connection of this process, or None if the file can't be used.
+        # called before the entries are counted, since a forked child may
+        # lose some of them when it takes over the table
+        if self._pid != os.getpid():
+            self._open()
+        return self._db
+
+    def _failed(self, error):
+        logging.getLogger('pythonrv').warning(
+            "Keeping the history in memory instead of in %s: %s", self._path, error)
+        self._db = None
+
+    def append(self, entry, timestamp=None):
+        if timestamp is None and self.window is not None:
+            timestamp = monotonic()
+        keys = self._index_keys(entry)
+        self._database()
+        evicted = []
+        if self.window is not None:
+            while len(self) and timestamp - self.timestamp(0) > self.window:
+                evicted.append(self.popleft())
+        if self.capacity is not None and len(self) == self.capacity:
+            evicted.append(self.popleft())
+
+        hot = self._hot
+        if len(hot) == hot.capacity:
+            # the oldest hot entry spills over to disk
+            self._disk_times.append(hot.timestamp(0))
+            self._write(self.appended - len(hot), hot.popleft())
+        self._indexed(self.appended, keys)
+        hot.append(entry, timestamp)
+        self.appended += 1
+        return evicted
+
+    def _write(self, number, entry):
+        db = self._database()
+        self._disk_count += 1
+        if db is None:
+            self._in_memory[number] = entry
+            return
+        try:
+            data = sqlite3.Binary(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            self._in_memory[number] = entry
+            return
+        try:
+            db.execute("INSERT INTO %s VALUES (?, ?)" % self._table, (number, data))
+        except sqlite3.Error as e:
+            self._failed(e)
+            self._in_memory[number] = entry
+
+    def _select(self, start, end):
+        # the rows of the entries numbered start up to end in the file
+        db = self._database()
+        if db is None:
+            return []
+        return db.execute("SELECT number, data FROM %s WHERE number >= ? AND number < ? "
+                "ORDER BY number" % self._table, (start, end)).fetchall()
+
+    def _read(self, number, data):
+        if number in self._in_memory:
+            return self._in_memory[number]
+        if data is None:
+            raise IndexError("The history entry %d is no longer in %s" % (number, self._path))
+        entry = pickle.loads(bytes(data))
+        if self._loaded:
+            self._loaded(entry, self)
+        return entry
+
+    def _load(self, number):
+        if number in self._in_memory:
+            return self._in_memory[number]
+        rows = self._select(number, number + 1)
+        return self._read(number, rows[0][1] if rows else None)
+
+    def popleft(self):
+        db = self._database()
+        if not len(self):
+            raise IndexError("pop from an empty history")
+        self._unindexed(self.appended - len(self))
+        if not self._disk_count:
+            return self._hot.popleft()
+        number = self._disk_first
+        self._disk_first += 1
+        self._disk_count -= 1
+        self._disk_times.popleft()
+        if number in self._in_memory:
+            return self._in_memory.pop(number)
+        # an entry that can't be read back is evicted all the same
+        entry = None
+        try:
+            entry = self._load(number)
+            db.execute("DELETE FROM %s WHERE number = ?" % self._table, (number,))
+        except (sqlite3.Error, IndexError):
+            pass
+        return entry
+
+    def entry(self, number):
+        first = self.appended - len(self)
+        if first <= number < self.appended:
+            return self[number - first]
+        return None
+
+    def timestamp(self, index):
+        index = self._index(index)
+        if index < self._disk_count:
+            return self._disk_times[index]
+        return self._hot.timestamp(index - self._disk_count)
+
+    def retained_bytes(self):
+        """
+        Returns the total size of the entries kept in memory, as estimated by
+        sizeof: the hot ones, and the ones that aren't in the file.
+        """
+        sizeof = self._hot.sizeof
+        return self._hot.retained_bytes() + sum(sizeof(entry) for entry in self._in_memory.values())
+
+    def clear(self):
+        self._clear_indexes()
+        db = self._database()
+        if db is not None:
+            try:
+                db.execute("DELETE FROM %s" % self._table)
+            except sqlite3.Error:
+                pass
+        self._in_memory.clear()
+        self._hot.clear()
+        self._disk_first = self.appended - len(self._hot)
+        self._disk_count = 0
+        self._disk_times.clear()
+
+    def _index(self, index):
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("history index out of range")
+        return index
+
+    def __len__(self):
+        self._database()
+        return self._disk_count + len(self._hot)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        self._database()
+        index = self._index(index)
+        if index < self._disk_count:
+            return self._load(self._disk_first + index)
+        return self._hot[index - self._disk_count]
+
+    def __iter__(self):
+        # streams the entries on disk in batches, and then the hot ones
+        self._database()
+        number = self._disk_first
+        end = self._disk_first + self._disk_count
+        while number < end:
+            batch = min(number + 100, end)
+            rows = dict(self._select(number, batch))
+            for number in xrange(number, batch):
+                yield self._read(number, rows.get(number))
+            number = batch
+        for entry in list(self._hot):
+            yield entry
+
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __repr__(self):
+        return "DiskHistory(%d on disk, %s, capacity=%s, window=%s)" % \
+            (self._disk_count, list(self._hot), self.capacity, self.window)
@@ -1,13 +1,31 @@
 # -*- coding: utf-8 -*-
+import sys
 import types
 import inspect
 import copy
+import copy_reg
+import time
+import weakref
+import collections
 
 from .dotdict import dotdict
 
 DEEP_COPY_FUNC = copy.deepcopy
 NO_COPY_FUNC = lambda x: x
-copy_func = DEEP_COPY_FUNC
+
+CAPTURE_DEEP = 'deep'
+CAPTURE_SHALLOW = 'shallow'
+CAPTURE_NONE = 'none'
+CAPTURE_MODES = [CAPTURE_DEEP, CAPTURE_SHALLOW, CAPTURE_NONE]
+
+# the copy budget, see set_copy_budget
+copy_budget = None
+rolling_copy_budget = None
+rolling_copy_window = 100
+# called with the wrapped function, the old and new capture modes and a
+# message when a function exceeds its copy budget
+on_capture_downgrade = None
+timer = getattr(time, 'perf_counter', time.time)
 
 def instrument(obj, func, pre=None, post=None, attach=True, extra=None):
     """
@@ -41,11 +59,15 @@ def instrument(obj, func, pre=None, post=None, attach=True, extra=None):
 
     wrapper, _prv = setup_wrapper(obj, func, attach)
 
-    # update _prv with extra data
+    # update _prv with extra data. a wrapper that is instrumented again keeps
+    # the extra data it was first given
     for key, item in extra.items():
+        if key in _prv.extra:
+            continue
         if key in _prv:
             raise ValueError("extra data cannot overide existing attribute (%s) in _prv" % key)
         _prv[key] = item
+        _prv.extra.add(key)
 
     # populate the wrapper with the given pre/post-functions
     def populate(container, value):
@@ -53,12 +75,6 @@ def instrument(obj, func, pre=None, post=None, attach=True, extra=None):
             return
         if hasattr(value, '__call__'):
             container.append(value)
-            if hasattr(value, '_prv_use_state'):
-                use_state = value._prv_use_state
-                for k, v in use_state.items():
-                    if v:
-                        _prv.use_state[k] = True
-                _prv.use_state['use'] = True
         else:
             try:
                 # try to iterate through the value; works if it is an iterable
@@ -67,11 +83,34 @@ def instrument(obj, func, pre=None, post=None, attach=True, extra=None):
             except TypeError as e:
                 raise TypeError("Contract condition %s is not callable" % p, e)
 
-    populate(_prv.pre, pre)
-    populate(_prv.post, post)
+    # the condition lists are never modified in place, since a running wrapper
+    # might be iterating over them
+    new_pre, new_post = [], []
+    populate(new_pre, pre)
+    populate(new_post, post)
+    # a wrapper that is instrumented again with the same function calls it once
+    _prv.pre = _prv.pre + [p for p in new_pre if p not in _prv.pre]
+    _prv.post = _prv.post + [p for p in new_post if p not in _prv.post]
+    rebuild_wrapper(_prv)
 
+    if _prv.attached:
+        wrapper = getattr(_prv.container, _prv.name)
     return wrapper
 
+def uninstrument(func, pre=None, post=None):
+    """
+    Removes the functions in pre and post from the wrapper of the instrumented
+    function func. When no pre- or post-functions remain, the original function
+    is restored on its container object. It is reinstalled as soon as new
+    functions are added through instrument.
+    """
+    _prv = func._prv
+    pre = pre if isinstance(pre, (list, tuple)) else [pre]
+    post = post if isinstance(post, (list, tuple)) else [post]
+    _prv.pre = [p for p in _prv.pre if p not in pre]
+    _prv.post = [p for p in _prv.post if p not in post]
+    rebuild_wrapper(_prv)
+
 def setup_wrapper(obj, func, attach=True):
 
     # classmethods and staticmethods are wrapped win an object
@@ -82,9 +121,13 @@ def setup_wrapper(obj, func, attach=True):
     if hasattr(inner_func, '_prv'):
         return inner_func, inner_func._prv
 
-    wrapper = make_wrapper()
-
-    copy_function_details(wrapper, inner_func)
+    # the target function might have been rewritten before, and then released
+    # when nothing observed it any longer, or it is wrapped already and was
+    # referred to before that. reuse that wrapper
+    if attach:
+        _prv = _released_wrapper(obj, inner_func.__name__) or _attached_wrapper(obj, inner_func)
+        if _prv:
+            return _prv.wrapper, _prv
 
     # the dict to store data for the wrapper
     _prv = dotdict()
@@ -95,9 +138,27 @@ def setup_wrapper(obj, func, attach=True):
     _prv.use_state.use = False
     _prv.use_state.inargs = False
     _prv.use_state.global_store = False
-    _prv.state = dotdict()
+    _prv.global_store = {}
+    _prv.copy_func = None
+    _prv.is_generator = inspect.isgeneratorfunction(inner_func)
+    # the capture plans of conditions, per wrapper, overriding the ones they
+    # have been decorated with
+    _prv.captures = {}
+    _prv.capture = None
+    # copy functions besides copy_func, each making its own copies of the
+    # arguments into state.incopies and state.outcopies
+    _prv.copy_funcs = ()
+    _reset_copy_budget(_prv)
+    _prv.extra = set()
+    _prv.container = None
+    _prv.attached = False
+
+    wrapper = make_wrapper(_prv)
+
+    copy_function_details(wrapper, inner_func)
 
     wrapper._prv = _prv
+    _prv.wrapper = wrapper
 
     args, varargs, varkw, defaults = inspect.getargspec(inner_func)
 
@@ -120,129 +181,499 @@ def setup_wrapper(obj, func, attach=True):
         # class method
         wrapper = classmethod(wrapper)
 
+    # the target might have changed above, so specialize the wrapper for it
+    rebuild_wrapper(_prv)
+
     if attach:
         # attach the wrapper to the target functions container object
         # use the "outer" function, which can be accessed through normal means
         if not hasattr(obj, inner_func.__name__):
             raise ValueError("Container object %s doesn't have an attribute %s" % (obj, func))
 
-        setattr(obj, inner_func.__name__, wrapper)
+        _prv.container = obj
+        _prv.name = inner_func.__name__
+        # the attribute as it is stored on the container, so that it can be
+        # restored. it is missing if it is inherited, e.g. from the class of
+        # an instance
+        _prv.original = _own_attribute(obj, _prv.name)
+        _prv.descriptor = wrapper
+
+        _attach(_prv)
         wrapper = getattr(obj, inner_func.__name__)
 
+    _register(_prv)
     return wrapper, _prv
 
-def make_wrapper():
+##################################################################
+### lazy instrumentation through an import hook
+##################################################################
+
+def when_imported(path, callback):
+    """
+    Calls callback(obj, func) for the function given by the dotted path, such
+    as "pkg.mod:Class.method", where obj is the container object of func. If the
+    module has not been imported yet, callback is called as soon as the module
+    has finished loading, before any other module can get a reference to the
+    function.
+    """
+    if ':' not in path:
+        raise ValueError("Dotted path %s must be of the form module:attribute" % path)
+    module_name, attributes = path.split(':', 1)
+
+    def resolve(module):
+        obj = module
+        names = attributes.split('.')
+        for name in names[:-1]:
+            obj = getattr(obj, name)
+        if not hasattr(obj, names[-1]):
+            raise ValueError("Cannot access function %s in module %s" % (attributes, module_name))
+        callback(obj, getattr(obj, names[-1]))
+
+    if module_name in sys.modules:
+        resolve(sys.modules[module_name])
+    else:
+        _import_hook.add(module_name, resolve)
+
+class ImportHook(object):
+    """
+    A PEP 302 meta path finder that calls its callbacks for a module after the
+    module has been loaded by the normal import machinery.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.loading = set()
+
+    def add(self, module_name, callback):
+        self.pending.setdefault(module_name, []).append(callback)
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.pending and fullname not in self.loading:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        # let the rest of the import machinery do the actual loading
+        self.loading.add(fullname)
+        try:
+            __import__(fullname)
+        finally:
+            self.loading.discard(fullname)
+        module = sys.modules[fullname]
+
+        for callback in self.pending.pop(fullname, []):
+            callback(module)
+        if not self.pending:
+            sys.meta_path.remove(self)
+        return module
+
+_import_hook = ImportHook()
+
+##################################################################
+### registry of instrumented functions
+##################################################################
+
+# weak references to the data of all wrappers, by container and name for
+# wrappers attached to a container, and by the wrapper itself for the others.
+# the data refers to the container, so the registry mustn't keep it alive; an
+# entry is removed when its data is freed, before the id can be reused
+_registry = {}
+_enabled = True
+
+def _register(_prv):
+    if _prv.container is not None:
+        key = (id(_prv.container), _prv.name)
+    else:
+        key = (None, id(_prv.wrapper))
+
+    def forget(ref):
+        if _registry.get(key) is ref:
+            del _registry[key]
+
+    _registry[key] = weakref.ref(_prv, forget)
+
+def _registered(key):
+    ref = _registry.get(key)
+    return ref() if ref else None
+
+def registry():
+    """
+    Returns the data of all instrumented functions. Among others, it contains
+    the target function, and for functions that have been attached to a
+    container object, the container, the name of the function, and whether it
+    is currently attached.
+    """
+    entries = [ref() for ref in list(_registry.values())]
+    return [_prv for _prv in entries if _prv is not None]
+
+def disable():
+    """
+    Disables all wrappers. Attached wrappers are swapped for the original
+    functions, and the others just call their target functions.
+    """
+    global _enabled
+    _enabled = False
+    for _prv in registry():
+        rebuild_wrapper(_prv)
+
+def enable():
+    """
+    Enables all wrappers that have been disabled through disable.
+    """
+    global _enabled
+    _enabled = True
+    for _prv in registry():
+        rebuild_wrapper(_prv)
+
+def is_enabled():
+    return _enabled
+
+##################################################################
+### attaching and releasing wrappers
+##################################################################
+
+_MISSING = object()
+
+def _own_attribute(obj, name):
+    return getattr(obj, '__dict__', {}).get(name, _MISSING)
+
+def _attach(_prv):
+    setattr(_prv.container, _prv.name, _prv.descriptor)
+    _prv.attached = True
+
+def _release(_prv):
+    if _prv.original is _MISSING:
+        delattr(_prv.container, _prv.name)
+    else:
+        setattr(_prv.container, _prv.name, _prv.original)
+    _prv.attached = False
+
+def _released_wrapper(obj, name):
+    _prv = _registered((id(obj), name))
+    if not _prv or _prv.container is not obj or _prv.attached:
+        return None
+    if _own_attribute(obj, name) is not _prv.original:
+        # someone else has replaced the function since it was released
+        return None
+    return _prv
+
+def _attached_wrapper(obj, func):
+    _prv = _registered((id(obj), func.__name__))
+    if not _prv or _prv.container is not obj or not _prv.attached:
+        return None
+    if getattr(_prv.target, '__func__', _prv.target) is not func:
+        return None
+    return _prv
+
+def _update_attachment(_prv):
+    # only wrappers that are in use should be attached
+    if _prv.container is None:
+        return
+    observed = _enabled and (len(_prv.pre) > 0 or len(_prv.post) > 0)
+    if observed and not _prv.attached:
+        _attach(_prv)
+    elif not observed and _prv.attached:
+        _release(_prv)
+
+##################################################################
+### wrapper code generation
+##################################################################
+
+# The wrapper is generated from source code specialized for its current set of
+# pre- and post-functions, so that every call only does the work it actually
+# needs. The generated function only closes over _prv, which means that it is
+# possible to swap the code of an existing wrapper when it has to be rebuilt;
+# references to the wrapper that have been handed out stay valid.
+
+_WRAPPER_TEMPLATE = """
+def make(_prv):
     def wrapper(*args, **kwargs):
-        if hasattr(wrapper, '_prv'):
-            # this is usually the case
-            _prv = wrapper._prv
-        elif hasattr(wrapper, '__func__') and hasattr(wrapper.__func__, '_prv'):
-            # this happens if wrapper has been made into a classmethod or a
-            # staticmethod. wrapper has been wrapped by descriptor objects; we can
-            # access the real wrapper through the __func__ attribute
-            _prv = wrapper.__func__._prv
-        else:
-            raise TypeError("wrapper is of a weird type...")
-
-        # setup possible use of state
-        use_state = _prv.use_state
-        state = _prv.state
-
-        # commence ugly hack:
-        # FIXME: this sets the copy_func for all specs for this wrapper. It should
-        # only be for the one needing a special copy_func.
-        local_copy_func = None
-        if hasattr(_prv, 'rv'):
-            if hasattr(_prv.rv, 'spec'):
-                for spec in _prv.rv.specs:
-                    local_copy_func = local_copy_func or spec._prv.spec_info.copy_func
-        local_copy_func = local_copy_func or copy_func
-
-        if use_state.use:
-            state.function_name = _prv.target.__name__
-            state.args = args
-            state.kwargs = kwargs
-
-            # setup store in state
-            if use_state.global_store:
-                state.global_store = state.global_store or {}
-
-            # setup input args in state as copies of args
-            if use_state.inargs:
-                state.inargs = local_copy_func(args)
-                state.inkwargs = {}
-                state.inkwargs.update(local_copy_func(kwargs))
-
-            if use_state.rv:
-                state.rv = _prv.rv
-                state.wrapper = wrapper
-
-        def call_condition_with_self(p):
-            if hasattr(_prv.target, '__self__'):
-                # the target function was attached to an instance when we wrapped
-                # it, so the pre/post-functions will expect a self argument first.
-                # this is stored in the target's __self__ attribute
-                p(_prv.target.__self__, *args, **kwargs)
-            else:
-                p(*args, **kwargs)
-
-        def call_condition_with_state(p):
-            if hasattr(p, '_prv_use_state'):
-                # the condition has been marked that it wants to use "dbc state". send
-                # state as the only argument
-
-                # setup the conditions local store, if required
-                p_use_state = p._prv_use_state
-                if 'local_store' in p_use_state and p_use_state['local_store']:
-                    if not hasattr(p, '_prv_local_store'):
-                        p._prv_local_store = {}
-                    state.local_store = p._prv_local_store
-
-                p(state)
-
-                # cleanup
-                # TODO: fix
-                if 'local_store' in p_use_state and p_use_state['local_store']:
-                    del state.local_store
+%s
+    return wrapper
+"""
+
+_code_cache = {}
+
+def make_wrapper(_prv):
+    return _compile_wrapper(_wrapper_body(_prv))(_prv)
+
+def rebuild_wrapper(_prv):
+    """
+    Regenerates the code of the wrapper for _prv. Must be called whenever the
+    pre- or post-functions, the use of state or the target of the wrapper
+    changes.
+    """
+    _update_use_state(_prv)
+    _prv.wrapper.__code__ = make_wrapper(_prv).__code__
+    _update_attachment(_prv)
+
+def _update_use_state(_prv):
+    use_state = _prv.use_state
+    for k in use_state.__dict__.keys():
+        use_state[k] = False
+    plans = []
+    for p in _prv.pre + _prv.post:
+        if hasattr(p, '_prv_use_state'):
+            for k, v in p._prv_use_state.items():
+                if v and k != 'capture':
+                    use_state[k] = True
+            use_state.use = True
+            if p._prv_use_state.get('inargs') or p._prv_use_state.get('outargs'):
+                plans.append(_prv.captures.get(p, p._prv_use_state.get('capture')))
+    _prv.capture = merge_capture_plans(plans)
+
+def _compile_wrapper(body):
+    # wrappers with the same shape share the same code object
+    if body not in _code_cache:
+        namespace = {}
+        source = _WRAPPER_TEMPLATE % '\n'.join('        ' + line for line in body)
+        exec(compile(source, '<pythonrv wrapper>', 'exec'), globals(), namespace)
+        _code_cache[body] = namespace['make']
+    return _code_cache[body]
+
+def _wrapper_body(_prv):
+    use_state = _prv.use_state
+    # the target function was attached to an instance when we wrapped it, so
+    # the pre/post-functions will expect a self argument first. this is
+    # stored in the target's __self__ attribute
+    bound = hasattr(_prv.target, '__self__')
+
+    if not _enabled:
+        return ("return _prv.target(*args, **kwargs)",)
+
+    body = []
+    # a wrapper that is running keeps using the conditions it started with
+    if _prv.pre:
+        body.append("pre = _prv.pre")
+    if _prv.post:
+        body.append("post = _prv.post")
+    if use_state.use:
+        body.append("state = CallFrame(_prv.target.__name__, args, kwargs)")
+        # setup store in state
+        if use_state.global_store:
+            body.append("state.global_store = _prv.global_store")
+        # setup input args in state as copies of args
+        if use_state.inargs:
+            body += _copy_setup_body()
+            if _prv.capture and _prv.capture.inputs is not None:
+                body.append("state.inargs, state.inkwargs = "
+                        "snapshot(_prv.capture.inputs, args, kwargs, copy)")
             else:
-                call_condition_with_self(p)
+                body += ["state.inargs = copy(args)",
+                        "state.inkwargs = dict(copy(kwargs))"]
+            if _prv.copy_funcs:
+                body.append("state.incopies = copy_all(_prv.copy_funcs, _prv.capture, "
+                        "args, kwargs%s)" % _mode_argument())
+            if _budgeted():
+                if use_state.outargs:
+                    body.append("copy_time = timer() - copy_start")
+                else:
+                    body.append("charge_copy(_prv, timer() - copy_start)")
+        if use_state.rv:
+            body += ["state.rv = _prv.rv",
+                    "state.wrapper = _prv.wrapper"]
+
+    # pre-functions
+    body += _conditions_body('pre', _prv.pre, bound)
 
-        # pre-functions
-        for p in _prv.pre:
-            call_condition_with_state(p)
+    # copy result into state
+    post_body = []
+    if use_state.use:
+        post_body.append("state.result = result")
+        if use_state.outargs:
+            post_body += _outargs_body(_prv)
 
+    # post-functions
+    post_body += _conditions_body('post', _prv.post, bound)
+
+    if _prv.is_generator and _prv.post:
+        body += _stream_body(_prv, bound)
+    else:
         # target function
-        result = _prv.target(*args, **kwargs)
-
-        # copy result into state
-        if use_state.use:
-            state.result = result
-
-            if use_state.outargs:
-                state.outargs = local_copy_func(args)
-                state.outkwargs = {}
-                state.outkwargs.update(local_copy_func(kwargs))
-
-
-        # post-functions
-        for p in _prv.post:
-            call_condition_with_state(p)
-
-        # cleanup state
-        if use_state.use:
-            if 'inargs' in state:
-                del state.inargs
-                del state.inkwargs
-            if 'outargs' in state:
-                del state.outargs
-                del state.outkwargs
-            state.args = None
-            state.kwargs = None
-            if hasattr(state, 'result'):
-                del state.result
-
-        return result
-    return wrapper
+        body.append("result = _prv.target(*args, **kwargs)")
+        body += post_body
+        body.append("return result")
+    return tuple(body)
+
+def _budgeted():
+    return copy_budget is not None or rolling_copy_budget is not None
+
+def _copy_setup_body():
+    if not _budgeted():
+        return ["copy = _prv.copy_func or copy_func"]
+    # the capture mode can't change during a call
+    return ["state.capture_mode = _prv.capture_mode",
+            "copy = degrade_copy_func(_prv.copy_func or copy_func, state.capture_mode)",
+            "copy_start = timer()"]
+
+def _mode_argument():
+    return ", state.capture_mode" if _budgeted() else ""
+
+def _outargs_body(_prv):
+    body = []
+    if not _prv.use_state.inargs:
+        body += _copy_setup_body()
+    elif _budgeted():
+        body.append("copy_start = timer()")
+    if _prv.copy_funcs:
+        body.append("state.outcopies = copy_all_after(_prv.copy_funcs, _prv.capture, "
+                "args, kwargs, state.incopies%s)" % _mode_argument())
+    if _prv.capture and _prv.capture.outputs is not None:
+        body.append("state.outargs, state.outkwargs = "
+                "snapshot(_prv.capture.outputs, args, kwargs, copy)")
+    elif _prv.use_state.inargs and not (_prv.capture and _prv.capture.inputs is not None):
+        # the whole arguments were copied before the call as well, so the
+        # copies of the parts that haven't changed can be shared
+        body.append("state.outargs, state.outkwargs = "
+                "copy_after(copy, args, kwargs, state.inargs, state.inkwargs)")
+    else:
+        body += ["state.outargs = copy(args)",
+                "state.outkwargs = dict(copy(kwargs))"]
+    if _budgeted():
+        if _prv.use_state.inargs:
+            body.append("charge_copy(_prv, copy_time + timer() - copy_start)")
+        else:
+            body.append("charge_copy(_prv, timer() - copy_start)")
+    return body
+
+def _stream_body(_prv, bound):
+    # the post-functions of a generator function are called once for every
+    # item it produces, and the ones that use state once more when it is
+    # exhausted
+    use_state = _prv.use_state
+    body = ["result = _prv.target(*args, **kwargs)",
+            "def on_item(item, index):"]
+    if use_state.use:
+        body += ["    state.item = item",
+                "    state.index = index"]
+    body += ["    " + line for line in _conditions_body('post', _prv.post, bound)]
+
+    end_conditions = [p for p in _prv.post if hasattr(p, '_prv_use_state')]
+    if end_conditions:
+        body += ["def on_end(count):",
+                "    if count > 0:",
+                "        del state.item",
+                "        del state.index",
+                "    state.end_of_stream = True",
+                "    state.count = count"]
+        if use_state.outargs:
+            body += ["    " + line for line in _outargs_body(_prv)]
+        # only call the conditions using state, by keeping their index in post
+        for i, p in enumerate(_prv.post):
+            if p in end_conditions:
+                body += ["    " + line for line in _conditions_body('post', [p], bound, i)]
+    else:
+        body.append("on_end = None")
+
+    body.append("result = stream(result, on_item, on_end)")
+    if use_state.use:
+        body.append("state.result = result")
+    body.append("return result")
+    return body
+
+def _conditions_body(container, conditions, bound, offset=0):
+    body = []
+    for i, p in enumerate(conditions):
+        p_ref = "%s[%d]" % (container, i + offset)
+        if hasattr(p, '_prv_use_state'):
+            # the condition has been marked that it wants to use "dbc state".
+            # send state as the only argument
+            local_store = p._prv_use_state.get('local_store', False)
+            if local_store:
+                # setup the conditions local store
+                if not hasattr(p, '_prv_local_store'):
+                    p._prv_local_store = {}
+                body.append("state.local_store = %s._prv_local_store" % p_ref)
+            body.append("%s(state)" % p_ref)
+            if local_store:
+                body.append("del state.local_store")
+        elif bound:
+            body.append("%s(_prv.target.__self__, *args, **kwargs)" % p_ref)
+        else:
+            body.append("%s(*args, **kwargs)" % p_ref)
+    return body
+
+##################################################################
+### generators
+##################################################################
+
+def stream(generator, on_item, on_end=None):
+    """
+    Produces the items of generator, and calls on_item(item, index) for each
+    one before it is passed on. If the generator is exhausted, on_end(count) is
+    called with the number of items. Values sent or exceptions thrown into the
+    stream are passed on to the generator. Nothing is stored, so streams of any
+    length can be monitored.
+    """
+    index = 0
+    value, exc_info = None, None
+    while True:
+        try:
+            if exc_info:
+                item = generator.throw(*exc_info)
+            elif value is None:
+                item = next(generator)
+            else:
+                item = generator.send(value)
+        except StopIteration:
+            break
+        value, exc_info = None, None
+
+        on_item(item, index)
+        index += 1
+
+        try:
+            value = yield item
+        except GeneratorExit:
+            generator.close()
+            raise
+        except:
+            exc_info = sys.exc_info()
+
+    if on_end:
+        on_end(index)
+
+class CallFrame(object):
+    """
+    The state of a single call to a wrapper, which is sent to the pre- and
+    post-functions that use state. Every call gets its own frame, so wrappers
+    can be called recursively and from several threads at once.
+
+    Just as a dotdict, fields that haven't been set are None.
+    """
+    __slots__ = ('function_name', 'args', 'kwargs', 'inargs', 'inkwargs',
+            'result', 'outargs', 'outkwargs', 'incopies', 'outcopies', 'capture_mode',
+            'global_store', 'local_store',
+            'item', 'index', 'end_of_stream', 'count', 'aggregates',
+            'rv', 'record', 'wrapper')
+
+    def __init__(self, function_name, args, kwargs):
+        self.function_name = function_name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __getattr__(self, attr):
+        # only called for fields that haven't been set
+        if attr in _CALL_FRAME_FIELDS:
+            return None
+        raise AttributeError(attr)
+
+    def __getitem__(self, attr):
+        return getattr(self, attr)
+
+    def __contains__(self, attr):
+        try:
+            object.__getattribute__(self, attr)
+            return True
+        except AttributeError:
+            return False
+
+    def __repr__(self):
+        return "CallFrame(%s)" % dict((attr, getattr(self, attr))
+                for attr in CallFrame.__slots__ if attr in self)
+
+_CALL_FRAME_FIELDS = frozenset(CallFrame.__slots__)
 
 def copy_function_details(dest, src):
     # copy some important attributes
@@ -254,8 +685,544 @@ def copy_function_details(dest, src):
     #dest.__kwdefaults__ = src.__kwdefaults__
     assert not hasattr(src, '__kwdefaults__')
 
+##################################################################
+### copying of arguments
+##################################################################
+
+# types whose instances can never change, and so never need to be copied. only
+# exact types are listed, since subclasses may add mutable attributes
+_IMMUTABLE_TYPES = set([type(None), bool, int, long, float, complex, str,
+    unicode, type, types.ClassType, xrange, types.FunctionType,
+    types.BuiltinFunctionType, types.CodeType, type(Ellipsis),
+    type(NotImplemented)])
+
+# user registered copiers, type -> fn(value)
+_copiers = {}
+# the cached dispatch table, type -> fn(value, memo)
+_dispatch = {}
+
+def register_copier(cls, fn):
+    """
+    Registers fn as the copier of instances of cls and its subclasses, to be
+    used instead of deepcopy when snapshotting arguments. fn is called with the
+    value to copy and should return the copy. It need not be deep, if the
+    parts of the value it shares with the original are never changed.
+    """
+    if not isinstance(cls, (type, types.ClassType)):
+        raise ValueError("Copiers can only be registered for types, not %s" % repr(cls))
+    if not callable(fn):
+        raise ValueError("The copier for %s must be callable" % cls.__name__)
+    _copiers[cls] = fn
+    _dispatch.clear()
+
+def registry_copy(value):
+    """
+    Copies value as deepcopy would, but through the dispatch table of
+    registered and built-in copiers.
+    """
+    return _copy(value, {})
+
+def _copy(value, memo):
+    return _copier(type(value))(value, memo)
+
+def _copier(cls):
+    try:
+        return _dispatch[cls]
+    except KeyError:
+        copier = _dispatch[cls] = _make_copier(cls)
+        return copier
+
+def _make_copier(cls):
+    if cls in _IMMUTABLE_TYPES:
+        return _copy_identity
+    registered = _registered_copier(cls)
+    if registered:
+        return _memoized(registered)
+    if cls is bytearray:
+        return _memoized(bytearray)
+    if cls is memoryview:
+        return _memoized(lambda value: value.tobytes())
+    if cls is buffer:
+        return _memoized(str)
+    if cls in _structural_copiers:
+        return _structural_copiers[cls]
+    if issubclass(cls, type):
+        return _copy_identity
+    if hasattr(cls, '__deepcopy__') or cls in copy._deepcopy_dispatch:
+        # copies itself, or is copied specially by deepcopy
+        return copy.deepcopy
+    return _copy_instance
+
+def _registered_copier(cls):
+    for base in inspect.getmro(cls):
+        if base in _copiers:
+            return _copiers[base]
+    return None
+
+def _copy_identity(value, memo):
+    return value
+
+def _memoized(fn):
+    def copier(value, memo):
+        d = id(value)
+        if d not in memo:
+            memo[d] = fn(value)
+        return memo[d]
+    return copier
+
+def _copy_list(value, memo):
+    d = id(value)
+    if d in memo:
+        return memo[d]
+    y = memo[d] = []
+    y.extend(_copy(v, memo) for v in value)
+    return y
+
+def _copy_dict(value, memo):
+    d = id(value)
+    if d in memo:
+        return memo[d]
+    y = memo[d] = {}
+    for k, v in value.iteritems():
+        y[_copy(k, memo)] = _copy(v, memo)
+    return y
+
+def _copy_tuple(value, memo):
+    d = id(value)
+    if d in memo:
+        return memo[d]
+    y = tuple(_copy(v, memo) for v in value)
+    # tuples of immutables are themselves immutable
+    if all(a is b for a, b in zip(value, y)):
+        y = value
+    memo[d] = y
+    return y
+
+def _copy_set(value, memo):
+    d = id(value)
+    if d in memo:
+        return memo[d]
+    elements = [_copy(v, memo) for v in value]
+    # frozensets of immutables are themselves immutable
+    if type(value) is frozenset and all(a is b for a, b in zip(value, elements)):
+        y = value
+    else:
+        y = type(value)(elements)
+    memo[d] = y
+    return y
+
+def _copy_instance(value, memo):
+    # copies value as deepcopy does, by reconstructing it from __reduce_ex__,
+    # but copies its state through the dispatch table, so that the registered
+    # copiers are used for the objects in it
+    d = id(value)
+    if d in memo:
+        return memo[d]
+    reduced = _reduce(value)
+    if isinstance(reduced, basestring):
+        # a global, such as a class
+        return value
+    # the reduced values might be temporary; keep them alive while their ids
+    # are in memo, as deepcopy does
+    copy._keep_alive(reduced, memo)
+
+    callable, args = reduced[:2]
+    state, listitems, dictitems = (tuple(reduced[2:]) + (None, None, None))[:3]
+    y = callable(*_copy(args, memo))
+    memo[d] = y
+    if state is not None:
+        state = _copy(state, memo)
+        if hasattr(y, '__setstate__'):
+            y.__setstate__(state)
+        else:
+            slotstate = None
+            if isinstance(state, tuple) and len(state) == 2:
+                state, slotstate = state
+            if state:
+                y.__dict__.update(state)
+            if slotstate:
+                for key, v in slotstate.iteritems():
+                    setattr(y, key, v)
+    if listitems is not None:
+        for item in listitems:
+            y.append(_copy(item, memo))
+    if dictitems is not None:
+        for key, v in dictitems:
+            y[_copy(key, memo)] = _copy(v, memo)
+    return y
+
+def _reduce(value):
+    reductor = copy_reg.dispatch_table.get(type(value))
+    if reductor:
+        return reductor(value)
+    return value.__reduce_ex__(2)
+
+_structural_copiers = {
+    list: _copy_list,
+    dict: _copy_dict,
+    tuple: _copy_tuple,
+    set: _copy_set,
+    frozenset: _copy_set,
+}
+
+def copy_after(copy, args, kwargs, inargs, inkwargs):
+    """
+    Copies args and kwargs after a call, reusing the parts of inargs and
+    inkwargs, their copies from before the call, that haven't changed since.
+    Only copies made by registry_copy are reused.
+    """
+    if copy is not registry_copy:
+        return copy(args), dict(copy(kwargs))
+    memo = {}
+    visited = {}
+    _find_unchanged(args, inargs, memo, visited)
+    _find_unchanged(kwargs, inkwargs, memo, visited)
+    return _copy(args, memo), dict(_copy(kwargs, memo))
+
+def _find_unchanged(value, copied, memo, visited):
+    # compares value with its earlier copy, and seeds memo with the copies of
+    # all sub-objects that are still equal to them, so that copying value
+    # again reuses those. the comparison doesn't short-circuit, so that
+    # unchanged parts of changed objects are found too
+    if value is copied:
+        return True
+    d = id(value)
+    if d in visited:
+        # None while comparing; objects in cycles are never reused, as they
+        # can't be compared before the rest of the cycle has been
+        return bool(visited[d])
+    if type(copied) is not type(value):
+        visited[d] = False
+        return False
+    visited[d] = None
+    unchanged = _compare_unchanged(value, copied, memo, visited)
+    visited[d] = unchanged
+    if unchanged:
+        memo[d] = copied
+    return unchanged
+
+def _compare_unchanged(value, copied, memo, visited):
+    cls = type(value)
+    if cls is list or cls is tuple:
+        if len(value) != len(copied):
+            return False
+        return _all_unchanged(zip(value, copied), memo, visited)
+    if cls is dict:
+        return _dict_unchanged(value, copied, memo, visited)
+    if cls is types.InstanceType:
+        return (value.__class__ is copied.__class__ and not hasattr(value, '__getstate__') and
+                _dict_unchanged(value.__dict__, copied.__dict__, memo, visited))
+    if _copier(cls) is _copy_instance:
+        return _instance_unchanged(value, copied, memo, visited)
+    try:
+        return bool(value == copied)
+    except Exception:
+        return False
+
+def _instance_unchanged(value, copied, memo, visited):
+    # instances are compared by what _copy_instance copies: the arguments and
+    # the state they are reconstructed from, including the values of their
+    # slots. their __eq__ might not look at all of it
+    try:
+        reduced = _reduced_parts(_reduce(value))
+        reduced_copy = _reduced_parts(_reduce(copied))
+    except Exception:
+        return False
+    if reduced is None or reduced_copy is None:
+        return False
+    # the reduced values might be temporary; keep them alive while their ids
+    # are in memo and visited
+    copy._keep_alive(reduced, memo)
+    copy._keep_alive(reduced_copy, memo)
+
+    callable, args, state, listitems, dictitems = reduced
+    if callable is not reduced_copy[0]:
+        return False
+    pairs = [(args, reduced_copy[1]), (listitems, reduced_copy[3]),
+            (dictitems, reduced_copy[4])]
+    unchanged = _state_unchanged(state, reduced_copy[2], memo, visited)
+    for items, copied_items in pairs:
+        if items is None or copied_items is None:
+            unchanged = unchanged and items is copied_items
+        elif len(items) != len(copied_items):
+            unchanged = False
+        else:
+            unchanged = _all_unchanged(zip(items, copied_items), memo, visited) and unchanged
+    return unchanged
+
+def _reduced_parts(reduced):
+    # (callable, args, state, list items, dict items), or None for globals
+    if isinstance(reduced, basestring):
+        return None
+    callable, args = reduced[:2]
+    state, listitems, dictitems = (tuple(reduced[2:]) + (None, None, None))[:3]
+    if listitems is not None:
+        listitems = list(listitems)
+    if dictitems is not None:
+        dictitems = list(dictitems)
+    return callable, tuple(args), state, listitems, dictitems
+
+def _state_unchanged(state, copied, memo, visited):
+    if state is None or copied is None:
+        return state is copied
+    if type(state) is dict and type(copied) is dict:
+        return _dict_unchanged(state, copied, memo, visited)
+    if (type(state) is tuple and len(state) == 2 and
+            type(copied) is tuple and len(copied) == 2):
+        # the state and the slot state of the instance
+        unchanged = _state_unchanged(state[0], copied[0], memo, visited)
+        return _state_unchanged(state[1], copied[1], memo, visited) and unchanged
+    return _find_unchanged(state, copied, memo, visited)
+
+def _dict_unchanged(value, copied, memo, visited):
+    if len(value) != len(copied):
+        return False
+    pairs = []
+    for k, v in value.iteritems():
+        if k not in copied:
+            return False
+        pairs.append((v, copied[k]))
+    return _all_unchanged(pairs, memo, visited)
+
+def _all_unchanged(pairs, memo, visited):
+    unchanged = True
+    for value, copied in pairs:
+        unchanged = _find_unchanged(value, copied, memo, visited) and unchanged
+    return unchanged
+
+def copy_all(copy_funcs, capture, args, kwargs, mode=CAPTURE_DEEP):
+    """
+    Copies args and kwargs once with each of copy_funcs, degraded to mode,
+    returning a dict of copy function -> (args copy, kwargs copy).
+    """
+    tree = capture.inputs if capture else None
+    return dict((c, snapshot(tree, args, kwargs, degrade_copy_func(c, mode)))
+            for c in copy_funcs)
+
+def copy_all_after(copy_funcs, capture, args, kwargs, incopies, mode=CAPTURE_DEEP):
+    """
+    As copy_all, but after a call, sharing the unchanged parts of incopies,
+    the copies made before it.
+    """
+    copies = {}
+    for c in copy_funcs:
+        copy = degrade_copy_func(c, mode)
+        if capture and capture.outputs is not None:
+            copies[c] = snapshot(capture.outputs, args, kwargs, copy)
+        elif incopies and (not capture or capture.inputs is None):
+            inargs, inkwargs = incopies[c]
+            copies[c] = copy_after(copy, args, kwargs, inargs, inkwargs)
+        else:
+            copies[c] = snapshot(None, args, kwargs, copy)
+    return copies
+
+##################################################################
+### copy budget
+##################################################################
+
+def shallow_copy(value):
+    """
+    Copies the argument tuple or dict value and each argument in it, sharing
+    everything the arguments refer to. Any other value is copied with
+    copy.copy.
+    """
+    if type(value) is tuple:
+        return tuple(copy.copy(v) for v in value)
+    if type(value) is dict:
+        return dict((k, copy.copy(v)) for k, v in value.iteritems())
+    return copy.copy(value)
+
+SHALLOW_COPY_FUNC = shallow_copy
+
+def degrade_copy_func(copy_func, mode):
+    """
+    Returns the copy function to use instead of copy_func in the capture mode
+    mode. Copy functions are only ever degraded, never upgraded.
+    """
+    if mode == CAPTURE_DEEP or copy_func is NO_COPY_FUNC:
+        return copy_func
+    if mode == CAPTURE_SHALLOW:
+        return SHALLOW_COPY_FUNC
+    return NO_COPY_FUNC
+
+def set_copy_budget(per_call=None, rolling=None, window=100):
+    """
+    Sets the time, in seconds, that copying the arguments of a wrapped function
+    may take, either for a single call (per_call), or in total for its last
+    window calls (rolling). None means no limit. A function exceeding its budget
+    has its capture mode downgraded one step, from deep copies to shallow ones
+    to no copies at all, and on_capture_downgrade is called.
+
+    Setting the budget resets the capture mode of all wrapped functions.
+    """
+    global copy_budget, rolling_copy_budget, rolling_copy_window
+    if window < 1:
+        raise ValueError("The copy budget window must be at least one call, not %s" % window)
+    copy_budget = per_call
+    rolling_copy_budget = rolling
+    rolling_copy_window = window
+    for _prv in registry():
+        _reset_copy_budget(_prv)
+        rebuild_wrapper(_prv)
+
+def _reset_copy_budget(_prv):
+    _prv.capture_mode = CAPTURE_DEEP
+    _prv.copy_times = collections.deque(maxlen=rolling_copy_window)
+    _prv.copy_total = 0.0
+
+def charge_copy(_prv, seconds):
+    """
+    Charges the time it took to copy the arguments of one call to the budget of
+    the wrapped function, and downgrades its capture mode when the budget is
+    exceeded.
+    """
+    # this isn't synchronized between threads; the budget is a heuristic, and
+    # a lost update only delays a downgrade
+    if copy_budget is not None and seconds > copy_budget:
+        _downgrade_capture(_prv, seconds, copy_budget, 1)
+    elif rolling_copy_budget is not None:
+        times = _prv.copy_times
+        if len(times) == times.maxlen:
+            _prv.copy_total -= times[0]
+        times.append(seconds)
+        _prv.copy_total += seconds
+        if _prv.copy_total > rolling_copy_budget:
+            _downgrade_capture(_prv, _prv.copy_total, rolling_copy_budget, len(times))
+
+def _downgrade_capture(_prv, seconds, budget, calls):
+    mode = _prv.capture_mode
+    if mode == CAPTURE_NONE:
+        return
+    _reset_copy_budget(_prv)
+    _prv.capture_mode = CAPTURE_MODES[CAPTURE_MODES.index(mode) + 1]
+    if on_capture_downgrade:
+        on_capture_downgrade(_prv.target, mode, _prv.capture_mode,
+                "copying the arguments of %s took %.6fs over %d call(s), exceeding "
+                "the budget of %.6fs; downgraded from %s to %s copies" %
+                (_prv.target.__name__, seconds, calls, budget, mode, _prv.capture_mode))
+
+REGISTRY_COPY_FUNC = registry_copy
+copy_func = REGISTRY_COPY_FUNC
+
+##################################################################
+### selective capture of arguments
+##################################################################
+
+class CapturePlan(object):
+    """
+    Declares which parts of the input and output arguments are read, and
+    should be snapshotted. capture is a dict with the keys 'inputs' and
+    'outputs', each a list of paths such as '0.board' (the attribute board of
+    the first positional argument) or 'y' (the keyword argument y). Path
+    elements are attribute names, dict keys or sequence indices. Without
+    'outputs', the outputs are captured with the paths of 'inputs'.
+
+    The paths are compiled into trees once. In a tree, None means that the
+    whole value is snapshotted; None instead of a tree means that all arguments
+    are.
+    """
+    def __init__(self, capture=None):
+        capture = capture or {}
+        unknown = set(capture.keys()) - set(['inputs', 'outputs'])
+        if unknown:
+            raise ValueError("Unknown capture keys %s" % ', '.join(sorted(unknown)))
+        self.inputs = _compile_paths(capture.get('inputs', []))
+        if 'outputs' in capture:
+            self.outputs = _compile_paths(capture['outputs'])
+        else:
+            self.outputs = copy.deepcopy(self.inputs)
+
+    def __repr__(self):
+        return "CapturePlan(inputs=%s, outputs=%s)" % (self.inputs, self.outputs)
+
+def _compile_paths(paths):
+    if isinstance(paths, basestring):
+        paths = [paths]
+    tree = {}
+    for path in paths:
+        _merge_trees(tree, reduce(lambda sub, name: {name: sub}, reversed(path.split('.')), None))
+    return tree
+
+def _merge_trees(a, b):
+    # merges b into a; either is None when everything is captured
+    if a is None or b is None:
+        return None
+    for name, sub in b.items():
+        if name in a:
+            a[name] = _merge_trees(a[name], sub)
+        else:
+            a[name] = copy.deepcopy(sub)
+    return a
+
+def merge_capture_plans(plans):
+    """
+    Merges plans into one capturing everything that each one does. A plan that
+    is None captures everything.
+    """
+    if not plans or None in plans:
+        return None
+    merged = CapturePlan()
+    for plan in plans:
+        merged.inputs = _merge_trees(merged.inputs, plan.inputs)
+        merged.outputs = _merge_trees(merged.outputs, plan.outputs)
+    return merged
+
+class Captured(object):
+    """
+    The snapshot of the captured attributes of an object.
+    """
+    def __getitem__(self, name):
+        return getattr(self, str(name))
+
+    def __repr__(self):
+        return "Captured(%s)" % self.__dict__
+
+def snapshot(tree, args, kwargs, copy):
+    """
+    Snapshots the parts of args and kwargs given by tree with copy. Positional
+    arguments that are not captured are None in the snapshot, and keyword
+    arguments are left out.
+    """
+    if tree is None:
+        return copy(args), dict(copy(kwargs))
+    snapped_args = [None] * len(args)
+    snapped_kwargs = {}
+    for name, sub in tree.items():
+        if name.isdigit():
+            i = int(name)
+            if i < len(args):
+                snapped_args[i] = _snapshot_value(args[i], sub, copy)
+        elif name in kwargs:
+            snapped_kwargs[name] = _snapshot_value(kwargs[name], sub, copy)
+    return tuple(snapped_args), snapped_kwargs
+
+def _snapshot_value(value, tree, copy):
+    if tree is None:
+        return copy(value)
+    if isinstance(value, dict):
+        snapped = {}
+        for name, sub in tree.items():
+            key = int(name) if name.isdigit() and name not in value else name
+            if key in value:
+                snapped[key] = _snapshot_value(value[key], sub, copy)
+        return snapped
+    if isinstance(value, (list, tuple)):
+        snapped = {}
+        for name, sub in tree.items():
+            if name.isdigit() and int(name) < len(value):
+                snapped[int(name)] = _snapshot_value(value[int(name)], sub, copy)
+        return snapped
+    snapped = Captured()
+    for name, sub in tree.items():
+        if hasattr(value, name):
+            setattr(snapped, name, _snapshot_value(getattr(value, name), sub, copy))
+    return snapped
+
 def use_state(**state_options):
     state_options = state_options or {}
+    if 'capture' in state_options:
+        # compile the capture plan once
+        state_options['capture'] = CapturePlan(state_options['capture'])
     def decorator(func):
         setattr(func, '_prv_use_state', state_options)
         return func
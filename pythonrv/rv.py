@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import logging
+import weakref
+import threading
+import itertools
+import operator
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from . import instrumentation
+from .history import History, DiskHistory, ColumnarHistory, HistoryWindow, monotonic, estimate_size
 from .dotdict import dotdict
 
 ##################################################################
@@ -16,6 +27,17 @@ DEFAULT_MAX_HISTORY_SIZE = 2
 INFINITE_HISTORY_SIZE = -1
 NO_HISTORY = 1
 
+GLOBAL_SCOPE = 'global'
+THREAD_SCOPE = 'thread'
+DEFAULT_HISTORY_SCOPE = GLOBAL_SCOPE
+
+OBJECTS_LAYOUT = 'objects'
+COMPACT_LAYOUT = 'compact'
+COLUMNAR_LAYOUT = 'columnar'
+DEFAULT_HISTORY_LAYOUT = OBJECTS_LAYOUT
+
+DEFAULT_HOT_HISTORY_SIZE = 100
+
 DEBUG = logging.DEBUG
 INFO = logging.INFO
 WARNING = logging.WARNING
@@ -33,6 +55,14 @@ def monitor(**monitorees):
         spec_info = _spec_info_for_spec(spec)
 
         for name, func in monitorees.items():
+            if isinstance(func, basestring):
+                # a dotted path, such as "pkg.mod:Class.method". the function
+                # is monitored once its module has been imported
+                monitor = Monitor(name, None, spec_info)
+                spec_info.add_monitor(monitor)
+                instrumentation.when_imported(func, _monitor_function_callback(spec, monitor))
+                continue
+
             obj = None
             if not hasattr(func, '__call__'):
                 # try to expand the func into both object and function
@@ -41,35 +71,253 @@ def monitor(**monitorees):
                 except:
                     raise ValueError("Function %s to monitor is not callable, or iterable of (obj, func)" % str(func))
 
-            if not _is_rv_instrumented(func):
-                func = instrumentation.instrument(obj, func, pre=pre_func_call, post=post_func_call,
-                        extra={'use_rv': True, 'rv': dotdict(specs=[])})
-
-            func_rv = func._prv.rv
-            func_rv.specs.append(spec)
-
-            spec_info.add_monitor(Monitor(name, func))
+            monitor = Monitor(name, None, spec_info)
+            _monitor_function(spec, monitor, obj, func)
+            spec_info.add_monitor(monitor)
 
         return spec
     return decorator
 
+def _monitor_function(spec, monitor, obj, func):
+    if not _is_rv_instrumented(func) or len(func._prv.rv.specs) == 0:
+        # the function is either not instrumented yet, or it was
+        # released when its last spec finished
+        func = instrumentation.instrument(obj, func, pre=pre_func_call, post=post_func_call,
+                extra={'use_rv': True, 'rv': _function_rv()})
+
+    # the specs list is never modified in place, since other threads might be
+    # iterating over it
+    func_rv = func._prv.rv
+    if spec not in func_rv.specs:
+        # a spec monitoring a function under several names gets one event per
+        # call, in which all of them are called
+        func_rv.specs = func_rv.specs + [spec]
+    monitor.function = func
+    by_wrapper = monitor.spec_info.monitors_by_wrapper
+    by_wrapper[func._prv.wrapper] = by_wrapper.get(func._prv.wrapper, ()) + (monitor,)
+    _update_function(func)
+
+def _function_rv():
+    # the rv data of an instrumented function. the calls of the function are
+    # logged once per phase, in logs, for the specs in sharing, when the
+    # phase is in logged; their monitors have windows into the log of the
+    # phase of their spec as their histories
+    return dotdict(specs=[], pre_specs=(), post_specs=(), end_of_stream_specs=(),
+            logs={PRE: History(1), POST: History(1)}, log_lock=threading.Lock(),
+            logged=frozenset(), sharing=frozenset())
+
+def _monitor_function_callback(spec, monitor):
+    def callback(obj, func):
+        if monitor.released:
+            # the spec finished before the function was imported
+            return
+        _monitor_function(spec, monitor, obj, func)
+    return callback
+
 def spec(**options):
     def decorator(spec_func):
         spec_info = _spec_info_for_spec(spec_func)
         spec_info.when = options.get('when', PRE)
         spec_info.error_level = options.get('level', DEFAULT_ERROR_LEVEL)
-        history_size = options.get('history_size', DEFAULT_MAX_HISTORY_SIZE)
+        history_window = options.get('history_window', None)
+        if history_window is not None and history_window <= 0:
+            raise ValueError("History windows must be positive, not %s" % history_window)
+        spec_info.history_window = history_window
+        # the key to keep the history sorted by, for range queries
+        spec_info.index = options.get('index', None)
+        # the key to look calls up by in the history
+        spec_info.history_key = options.get('history_key', None)
+
+        # histories kept on disk
+        spec_info.history_file = options.get('history_file', None)
+        spec_info.hot_history_size = options.get('hot_history_size', DEFAULT_HOT_HISTORY_SIZE)
+        if spec_info.hot_history_size < 1:
+            raise ValueError("Hot history sizes must be at least 1, not %d" % spec_info.hot_history_size)
+
+        history_max_bytes = options.get('history_max_bytes', None)
+        if history_max_bytes is not None and history_max_bytes <= 0:
+            raise ValueError("History byte budgets must be positive, not %s" % history_max_bytes)
+        spec_info.history_max_bytes = history_max_bytes
+
+        # a spec with a time window, a byte budget or a history on disk keeps
+        # all events by default
+        if history_window is None and spec_info.history_file is None and history_max_bytes is None:
+            default_size = DEFAULT_MAX_HISTORY_SIZE
+        else:
+            default_size = INFINITE_HISTORY_SIZE
+        history_size = options.get('history_size', default_size)
         if history_size < -1:
             raise ValueError("Negative max history sizes (%d) are not allowed" % history_size)
         if history_size == 0:
             history_size = 1
         spec_info.max_history_size = history_size
 
+        history_scope = options.get('history_scope', DEFAULT_HISTORY_SCOPE)
+        if history_scope not in (GLOBAL_SCOPE, THREAD_SCOPE):
+            raise ValueError("Unknown history scope %s" % history_scope)
+        spec_info.history_scope = history_scope
+
+        history_layout = options.get('history_layout', DEFAULT_HISTORY_LAYOUT)
+        if history_layout not in (OBJECTS_LAYOUT, COMPACT_LAYOUT, COLUMNAR_LAYOUT):
+            raise ValueError("Unknown history layout %s" % history_layout)
+        spec_info.history_layout = history_layout
+        spec_info.columns = _columns(options.get('columns', None))
+        if history_layout == COLUMNAR_LAYOUT:
+            if not spec_info.columns:
+                raise ValueError("Columnar histories need columns")
+            if spec_info.index or spec_info.history_key or spec_info.history_file:
+                raise ValueError("Columnar histories can't have an index, a key or a file")
+        if history_max_bytes is not None and (spec_info.history_file or history_layout == COLUMNAR_LAYOUT):
+            raise ValueError("History byte budgets can't be used with columnar or disk histories")
+
         enable_copy_args = options.get('enable_copy_args', True)
         spec_info.copy_func = None if enable_copy_args else instrumentation.NO_COPY_FUNC
+        capture = options.get('capture', None)
+        spec_info.capture = None if capture is None else instrumentation.CapturePlan(capture)
+
+        # monitored generator functions
+        spec_info.end_of_stream = options.get('end_of_stream', False)
+        spec_info.aggregates = options.get('aggregates', {})
+
+        # the spec might already monitor functions; their wrappers must be
+        # told about the new options
+        for monitor in spec_info.monitors.values():
+            if monitor.function:
+                _update_function(monitor.function)
         return spec_func
     return decorator
 
+def _columns(columns):
+    # the columns of a columnar history, by name. a list of names gives
+    # columns of the attributes of the calls with those names, such as result
+    if columns is None:
+        return {}
+    if isinstance(columns, dict):
+        return dict(columns)
+    return dict((name, operator.attrgetter(name)) for name in columns)
+
+def _update_function(func):
+    # the arguments are copied once for every distinct copy function of the
+    # specs, where None is the default one. the first is copied into
+    # state.inargs and state.outargs, and the others into state.incopies and
+    # state.outcopies
+    _prv = func._prv
+    copy_funcs = []
+    for spec in _prv.rv.specs:
+        copy_func = spec._prv.spec_info.copy_func
+        if not copy_func in copy_funcs:
+            copy_funcs.append(copy_func)
+    if None in copy_funcs:
+        copy_funcs.remove(None)
+        copy_funcs.insert(0, None)
+    _prv.copy_func = copy_funcs[0] if copy_funcs else None
+    _prv.copy_funcs = tuple(copy_funcs[1:])
+
+    # only snapshot what the specs read. the snapshot of the inputs is made
+    # before the call, so it is shared by the pre and post specs
+    plans = [spec._prv.spec_info.capture for spec in _prv.rv.specs]
+    capture = instrumentation.merge_capture_plans(plans) if plans else instrumentation.CapturePlan()
+    _prv.captures[pre_func_call] = _prv.captures[post_func_call] = capture
+
+    _update_call_logs(func)
+
+    # the specs of each phase, so that calls needn't look for them. a phase
+    # without specs is left out of the wrapper, along with the copies of the
+    # arguments it would need
+    func_rv = _prv.rv
+    func_rv.pre_specs = tuple(spec for spec in func_rv.specs if spec._prv.spec_info.when == PRE)
+    func_rv.post_specs = tuple(spec for spec in func_rv.specs if spec._prv.spec_info.when == POST)
+    # only some specs want to know when a generator is exhausted
+    func_rv.end_of_stream_specs = tuple(spec for spec in func_rv.post_specs
+            if spec._prv.spec_info.end_of_stream)
+    _prv.pre = _with_condition(_prv.pre, pre_func_call, func_rv.pre_specs)
+    _prv.post = _with_condition(_prv.post, post_func_call, func_rv.post_specs)
+    instrumentation.rebuild_wrapper(_prv)
+
+def _with_condition(conditions, condition, needed):
+    # the condition lists are never modified in place, since a running wrapper
+    # might be iterating over them
+    if needed and condition not in conditions:
+        return conditions + [condition]
+    if not needed and condition in conditions:
+        return [c for c in conditions if c is not condition]
+    return conditions
+
+def _update_call_logs(func):
+    # the calls are logged for the specs of a phase when at least two of them
+    # can share the log, which then holds as many calls as the largest of
+    # their histories. the calls of post specs are logged when they have
+    # finished, so that they are in the order of their results
+    _prv = func._prv
+    func_rv = _prv.rv
+    sharing = []
+    logged = []
+    for when in (PRE, POST):
+        spec_infos = [spec._prv.spec_info for spec in func_rv.specs
+                if spec._prv.spec_info.when == when and
+                _can_share_call_log(_prv, spec._prv.spec_info)]
+        if len(spec_infos) < 2:
+            continue
+        log = func_rv.logs[when]
+        sizes = [spec_info.max_history_size for spec_info in spec_infos]
+        with func_rv.log_lock:
+            log.resize(None if INFINITE_HISTORY_SIZE in sizes else max(sizes))
+            # monitors without histories see the calls made from now on
+            for spec_info in spec_infos:
+                for monitor in _monitors_of(spec_info, _prv):
+                    if 'history' not in monitor.__dict__:
+                        monitor.log_start = log.appended
+        sharing += spec_infos
+        logged.append(when)
+    old_sharing = func_rv.sharing
+    func_rv.sharing = frozenset(sharing)
+    func_rv.logged = frozenset(logged)
+
+    # the monitors of specs that no longer share a log keep the calls of
+    # their windows in histories of their own, and unused logs are emptied
+    for spec in func_rv.specs:
+        spec_info = spec._prv.spec_info
+        if spec_info in old_sharing and spec_info not in func_rv.sharing:
+            for monitor in _monitors_of(spec_info, _prv):
+                _detach_history(monitor)
+    for when, log in func_rv.logs.items():
+        if when not in func_rv.logged:
+            with func_rv.log_lock:
+                log.clear()
+
+def _monitors_of(spec_info, _prv):
+    return spec_info.monitors_by_wrapper.get(_prv.wrapper, ())
+
+def _can_share_call_log(_prv, spec_info):
+    # a monitor that already has a history of its own keeps it
+    if not _shares_call_log(_prv, spec_info):
+        return False
+    log = _prv.rv.logs[spec_info.when]
+    for monitor in _monitors_of(spec_info, _prv):
+        history = monitor.__dict__.get('history')
+        if history is not None and not (isinstance(history, HistoryWindow) and history.history is log):
+            return False
+    return True
+
+def _detach_history(monitor):
+    window = monitor.__dict__.pop('history', None)
+    if window is None:
+        return
+    for data in window:
+        _append_history(monitor, data, data.timestamp)
+
+def _shares_call_log(_prv, spec_info):
+    # generators are called once, but have an event per item; the other kinds
+    # of histories keep entries of their own
+    return (not _prv.is_generator and
+            spec_info.history_layout == OBJECTS_LAYOUT and
+            spec_info.history_scope == GLOBAL_SCOPE and
+            spec_info.history_window is None and
+            spec_info.history_max_bytes is None and
+            spec_info.history_file is None and
+            spec_info.index is None and
+            spec_info.history_key is None)
+
 def _is_rv_instrumented(func):
     return hasattr(func, '_prv') and not func._prv.rv is None
 
@@ -78,39 +326,143 @@ def _spec_info_for_spec(spec):
         spec._prv = dotdict()
     if 'spec_info' not in spec._prv:
         spec._prv.spec_info = SpecInfo()
+        _specs.add(spec)
     return spec._prv.spec_info
 
+# all specs, for stats
+_specs = weakref.WeakSet()
+
 ##################################################################
 ### info and data about specifications and monitors
 ##################################################################
 
+class _ScopedValue(object):
+    """
+    A value that is either shared between all threads, or local to each
+    thread, depending on the history scope of the spec. Its initial value is
+    made by initial, from the object with the value.
+
+    The scope is resolved when the value is first read. A shared value is then
+    kept in the dict of the object, under name, where later reads find it
+    without calling the descriptor. Scoped values are therefore never assigned
+    to, but changed in place.
+    """
+    def __init__(self, name, initial=lambda el: []):
+        self.name = name
+        self.initial = initial
+
+    def __get__(self, el, cls):
+        if el is None:
+            return self
+        if el.spec_info.history_scope == THREAD_SCOPE:
+            values = el._local.__dict__
+            if self.name not in values:
+                values[self.name] = self.initial(el)
+            return values[self.name]
+        return el.__dict__.setdefault(self.name, self.initial(el))
+
+def _new_history(el):
+    spec_info = el.spec_info
+    max_size = spec_info.max_history_size
+    capacity = None if max_size == INFINITE_HISTORY_SIZE else max_size
+    if isinstance(el, Monitor) and el.function and spec_info in el.function._prv.rv.sharing:
+        # the calls are logged by other threads while the window is read
+        func_rv = el.function._prv.rv
+        window = HistoryWindow(func_rv.logs[spec_info.when], capacity, el.log_start,
+                sizeof=_data_size, lock=func_rv.log_lock)
+        window.wrap = lambda record: FunctionCallData.from_record(el, record, window)
+        return window
+    if spec_info.history_layout == COLUMNAR_LAYOUT:
+        columns = dict((name, _history_key_function(el, func))
+                for name, func in spec_info.columns.items())
+        return ColumnarHistory(columns, capacity, spec_info.history_window)
+    index = _history_key_function(el, spec_info.index)
+    key = _history_key_function(el, spec_info.history_key)
+    if spec_info.history_file:
+        return DiskHistory(spec_info.history_file, spec_info.hot_history_size,
+                capacity, spec_info.history_window,
+                loaded=lambda data, history: _reattach_history(el, data, history),
+                index=index, key=key, sizeof=_data_size)
+    return History(capacity, spec_info.history_window, index, key,
+            spec_info.history_max_bytes, _data_size)
+
+def _history_key_function(el, key):
+    # keys are computed from calls; monitor histories hold calls, and spec
+    # histories events
+    if key is None or isinstance(el, Monitor):
+        return key
+    return lambda event_data: key(event_data.called_function)
+
 class SpecInfo(object):
+    oneshots = _ScopedValue('oneshots')
+    history = _ScopedValue('history', _new_history)
+
     def __init__(self):
         self.monitors = {}
-        self.oneshots = []
-        self.history = []
+        # the names of the monitors, and the monitors of the wrappers of their
+        # functions, to find the called ones
+        self.monitor_names = ()
+        self.monitors_by_wrapper = {}
         self.active = True
         self.when = PRE
         self.error_level = DEFAULT_ERROR_LEVEL
         self.max_history_size = DEFAULT_MAX_HISTORY_SIZE
+        self.history_window = None
+        self.history_max_bytes = None
+        self.history_file = None
+        self.index = None
+        self.history_key = None
+        self.hot_history_size = DEFAULT_HOT_HISTORY_SIZE
+        self.history_scope = DEFAULT_HISTORY_SCOPE
+        self.history_layout = DEFAULT_HISTORY_LAYOUT
+        self.columns = {}
         self.copy_func = None
+        self.capture = None
+        self.end_of_stream = False
+        self.aggregates = {}
+
+        # protects the history and the oneshots of the spec and its monitors
+        # when they are shared between threads
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def spec_info(self):
+        return self
 
     def add_monitor(self, monitor):
         self.monitors[monitor.name] = monitor
+        self.monitor_names = tuple(self.monitors)
 
     def __repr__(self):
-        return "SpecInfo(%s, active=%s, error_level=%s, max_history_size=%s, copy_func=%s)" % \
-            (self.monitors, self.active, self.error_level, self.max_history_size, self.copy_func)
+        return "SpecInfo(%s, active=%s, error_level=%s, max_history_size=%s, history_scope=%s, copy_func=%s)" % \
+            (self.monitors, self.active, self.error_level, self.max_history_size, self.history_scope, self.copy_func)
 
 class Monitor(object):
-    def __init__(self, name, function):
+    oneshots = _ScopedValue('oneshots')
+    history = _ScopedValue('history', _new_history)
+
+    def __init__(self, name, function, spec_info):
         self.name = name
         self.function = function
-        self.oneshots = []
-        self.history = []
+        self.spec_info = spec_info
+        self.released = False
+        self.log_start = 0
+        # the function in the events where it wasn't called
+        self.not_called = FunctionCallEvent(self, _not_called(name))
+        self._local = threading.local()
 
     def _remove_spec_from_function(self, spec):
-        self.function._prv.rv.specs.remove(spec)
+        self.released = True
+        if not self.function:
+            # the function has not been imported yet
+            return
+        func_rv = self.function._prv.rv
+        specs = func_rv.specs = [s for s in func_rv.specs if s is not spec]
+        _update_function(self.function)
+        if len(specs) == 0:
+            # nothing observes the function any longer; stop paying for it
+            instrumentation.uninstrument(self.function, pre=pre_func_call, post=post_func_call)
 
     def __repr__(self):
         return "Monitor('%s', %s)" % (self.name, self.function)
@@ -121,23 +473,63 @@ class Monitor(object):
 
 @instrumentation.use_state(rv=True, inargs=True)
 def pre_func_call(state):
-    pre_specs = [spec for spec in state.rv.specs if spec._prv.spec_info.when == PRE]
-    _call_specs(state, pre_specs)
+    if PRE in state.rv.logged:
+        _log_call(state, PRE)
+    _call_specs(state, state.rv.pre_specs)
 
 @instrumentation.use_state(rv=True, inargs=True, outargs=True)
 def post_func_call(state):
-    post_specs = [spec for spec in state.rv.specs if spec._prv.spec_info.when == POST]
-    _call_specs(state, post_specs)
+    if state.record is not None:
+        state.record.finish(state)
+    if POST in state.rv.logged:
+        _log_call(state, POST)
+    if state.end_of_stream:
+        _call_specs(state, state.rv.end_of_stream_specs)
+        return
+    if 'item' in state:
+        _update_aggregates(state, state.rv.post_specs)
+    _call_specs(state, state.rv.post_specs)
+
+def _log_call(state, when):
+    # the call is logged once per phase. the record of the pre specs is
+    # finished after the call
+    func_rv = state.rv
+    log = func_rv.logs[when]
+    record = state.record = CallRecord(monotonic(), state)
+    with func_rv.log_lock:
+        log.append(record, record.timestamp)
+        record.number = log.appended - 1
+
+def _update_aggregates(state, specs):
+    # the aggregates of the items produced by a generator, per spec, are kept
+    # in the state of the call, which lives as long as the generator
+    if state.aggregates is None:
+        state.aggregates = {}
+    for spec in specs:
+        spec_info = spec._prv.spec_info
+        if not spec_info.aggregates:
+            continue
+        values = state.aggregates.get(spec_info)
+        if values is None:
+            values = state.aggregates[spec_info] = dict((name, initial)
+                    for name, (func, initial) in spec_info.aggregates.items())
+        for name, (func, initial) in spec_info.aggregates.items():
+            values[name] = func(values[name], state.item)
 
 
 def _call_specs(state, specs):
     for spec in specs:
         # 1. Create event data from state
         spec_info = spec._prv.spec_info
-        event_data = EventData(spec_info, state)
+        monitors = spec_info.monitors_by_wrapper.get(state.wrapper)
+        if not monitors:
+            # the spec is still being set up, or released, by another thread
+            continue
+        event_data = EventData(spec_info, state, monitors)
 
         # 2. Make history
-        _make_history(spec_info, event_data)
+        with _lock_for(spec_info):
+            _make_history(spec_info, event_data)
 
         # 3. Create a "monitored event" to pass to the spec
         event = Event(spec, spec_info, event_data)
@@ -156,25 +548,45 @@ def _call_specs(state, specs):
 
 def _call_oneshots(spec_info, event):
     errors = []
-    monitor = event.called_function.monitor
-
-    def all_oneshots():
-        for oneshot in spec_info.oneshots:
-            yield oneshot
-        for oneshot in monitor.oneshots:
-            yield oneshot
-
-    for oneshot in all_oneshots():
+    monitors = [called.monitor for called in event.fn._calls]
+    if not spec_info.oneshots and not [m for m in monitors if m.oneshots]:
+        return errors
+
+    # take the oneshots, so that no other thread calls them as well
+    with _lock_for(spec_info):
+        oneshots = spec_info.oneshots[:]
+        del spec_info.oneshots[:]
+        for monitor in monitors:
+            oneshots += monitor.oneshots
+            del monitor.oneshots[:]
+
+    for oneshot in oneshots:
         try:
             oneshot(event)
         except AssertionError as e:
             errors.append(e)
 
-    spec_info.oneshots = []
-    monitor.oneshots = []
-
     return errors
 
+def _add_oneshot(spec_info, el, oneshot):
+    with _lock_for(spec_info):
+        el.oneshots.append(oneshot)
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_lock = _NoLock()
+
+def _lock_for(spec_info):
+    # thread-local histories and oneshots need no locking
+    if spec_info.history_scope == THREAD_SCOPE:
+        return _no_lock
+    return spec_info.lock
+
 def _call_spec(spec, event):
     if not _should_call_spec(spec, event):
         return []
@@ -212,103 +624,416 @@ def _cleanup_spec(spec, spec_info):
 ### history functions
 ##################################################################
 
-def _make_history(spec_info, event_data):
-    if len(spec_info.history) > 0:
-        event_data.prev = spec_info.history[-1]
-    else:
-        event_data.prev = None
-    spec_info.history.append(event_data)
-
-    func_data = event_data.called_function
-    monitor = spec_info.monitors[func_data.name]
-    if len(monitor.history) > 0:
-        func_data.prev = monitor.history[-1]
-    else:
-        func_data.prev = None
-    monitor.history.append(func_data)
+# orders all events, across threads
+_sequence = itertools.count()
 
-    # check sizes
-    _truncate_history(spec_info, spec_info.max_history_size)
-    _truncate_history(monitor, spec_info.max_history_size)
-
-def _truncate_history(el, max_len=None):
-    if max_len == INFINITE_HISTORY_SIZE:
-        return
-    if max_len is None:
-        max_len = DEFAULT_MAX_HISTORY_SIZE
-
-    if len(el.history) > max_len:
-        # we always have at least 1 in the history
-        el.history = el.history[-max_len:(max_len+1)]
-        if len(el.history) > 0:
-            el.history[0].prev = None
+def _make_history(spec_info, event_data):
+    event_data.seq = next(_sequence)
+    event_data.timestamp = monotonic()
+    if spec_info.history_layout == COMPACT_LAYOUT and len(spec_info.history) > 0:
+        # the previous event is no longer the current one, and only lives on
+        # in the history
+        _compact_call(spec_info, spec_info.history[-1])
+    _append_history(spec_info, event_data, event_data.timestamp)
+
+    for func_data in event_data.fn._calls:
+        monitor = spec_info.monitors[func_data.name]
+        if _slot(func_data, '_record') is not None:
+            # the call is already in the call log of the function, which the
+            # history of the monitor is a window into
+            func_data._history = monitor.history
+            continue
+        func_data.timestamp = event_data.timestamp
+        _append_history(monitor, func_data, event_data.timestamp)
+
+def _compact_call(spec_info, event_data):
+    for func_data in event_data.fn._calls:
+        func_data._compact()
+    if spec_info.history_max_bytes is not None:
+        # the sizes counted against the budget were measured before
+        spec_info.history.remeasure(event_data._number)
+        for func_data in event_data.fn._calls:
+            func_data._history.remeasure(func_data._number)
+
+def _append_history(el, data, timestamp):
+    # appending to the history evicts the oldest entries once it is full, or
+    # when they are older than its window. the entries refer to the history,
+    # and not to each other, so an evicted entry is freed even if a newer one
+    # is still referenced
+    history = el.history
+    history.append(data, timestamp)
+    data._history = history
+    data._number = history.appended - 1
+
+def _prev_in_history(data):
+    """
+    The entry before data in the history it was appended to, or None if it has
+    been evicted.
+    """
+    history = _slot(data, '_history')
+    if history is None:
+        return None
+    return history.entry(data._number - 1)
+
+def _data_size(data):
+    # the size of an entry of a history. only the data of the calls counts;
+    # the history, monitors and specs they refer to are shared, and so are the
+    # data of the functions that weren't called
+    if isinstance(data, EventData):
+        return sys.getsizeof(data) + sys.getsizeof(data.fn) + _data_size(data.called_function)
+    if isinstance(data, CallRecord):
+        return sys.getsizeof(data) + estimate_size([getattr(data, name) for name in data._STATE])
+    values = [_slot(data, name) for name in _SIZED_FIELDS]
+    return sys.getsizeof(data) + estimate_size(values)
+
+def _reattach_history(el, data, history):
+    # data read back from the disk history of el. the calls in an event read
+    # back are copies as well, and refer to the histories of their monitors
+    data._history = history
+    if isinstance(data, EventData):
+        for func_data in data.fn._calls:
+            func_data._history = el.monitors[func_data.name].history
+
+def _history_state(data):
+    # the state to pickle data with, in a disk history. the history it refers
+    # to is reattached when it is read back
+    state = {}
+    for name in data.__slots__:
+        value = _slot(data, name, _unset)
+        if value is not _unset and name != '_history':
+            state[name] = value
+    return state
+
+def _restore_state(data, state):
+    for name, value in state.items():
+        setattr(data, name, value)
+
+_unset = object()
+
+def _slot(obj, name, default=None):
+    # the value of a slot of obj, without falling back on __getattr__
+    try:
+        return object.__getattribute__(obj, name)
+    except AttributeError:
+        return default
 
 ##################################################################
 ### plain data objects
 ##################################################################
 
+# the data and events are made for every spec on every call, so they have no
+# instance dicts, and the functions that weren't called share the same objects
+
 class EventData(object):
-    def __init__(self, spec_info, state):
-        self.fn = EventDataFunctions(spec_info, state)
-        self.called_function = self.fn._called
+    __slots__ = ('fn', 'called_function', 'seq', 'timestamp', '_history', '_number')
+    prev = property(_prev_in_history)
+    __getstate__ = _history_state
+    __setstate__ = _restore_state
+
+    def __init__(self, spec_info, state, monitors):
+        calls = tuple(FunctionCallData(monitor, state) for monitor in monitors)
+        self.called_function = calls[0]
+        self.fn = EventDataFunctions(calls, spec_info.monitor_names)
 
     def __repr__(self):
         return "EventData(%s)" % (self.fn)
 
 class EventDataFunctions(object):
-    def __init__(self, spec_info, data):
-        self._functions = []
-        for name, monitor in spec_info.monitors.items():
-            em = FunctionCallData(monitor, data)
-            self._functions.append(em)
-            self.__dict__[name] = em
-            if em.called:
-                self._called = em
+    """
+    The data of the monitored functions in an event, by name. The functions
+    that weren't called are NotCalled.
+    """
+    __slots__ = ('_calls', '_names')
+
+    def __init__(self, calls, names):
+        # the data of the called functions; several monitors can watch one
+        # function under different names
+        self._calls = calls
+        self._names = names
+
+    def __getattr__(self, name):
+        calls = _slot(self, '_calls')
+        if calls is not None:
+            for called in calls:
+                if name == called.name:
+                    return called
+            if name in self._names:
+                return _not_called(name)
+        raise AttributeError(name)
 
     def __getitem__(self, name):
-        return self.__dict__[name]
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    @property
+    def _functions(self):
+        return [self[name] for name in self._names]
 
     def __repr__(self):
         return "EventDataFunctions(%s)" % self._functions
 
+class NotCalled(object):
+    """
+    The data of a monitored function that wasn't called in an event. There is
+    one per name, shared by all events, and it can't be changed.
+    """
+    __slots__ = ('name',)
+    called = False
+    prev = None
+
+    def __init__(self, name):
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NotCalled objects can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError("NotCalled objects can't be changed")
+
+    def __reduce__(self):
+        return (_not_called, (self.name,))
+
+    def __repr__(self):
+        return "FunctionCallData(%s, False)" % self.name
+
+_not_called_data = {}
+
+def _not_called(name):
+    data = _not_called_data.get(name)
+    if data is None:
+        data = _not_called_data.setdefault(name, NotCalled(name))
+    return data
+
 class FunctionCallData(object):
+    """
+    The data of a call of a monitored function. The values of a call kept in
+    a compact history are packed, and the ones of a call in a call log are
+    read from its record; both are unpacked, or read, when accessed.
+    """
+    __slots__ = ('name', 'called', 'timestamp', 'inputs', 'input_kwargs',
+            'outputs', 'output_kwargs', 'result', 'capture_mode', 'item', 'index',
+            'end_of_stream', 'count', 'aggregates', '_packed', '_record',
+            '_spec_info', '_history', '_number')
+    prev = property(_prev_in_history)
+    __getstate__ = _history_state
+    __setstate__ = _restore_state
+
     def __init__(self, monitor, state):
         self.name = monitor.name
-        if hasattr(monitor.function, '__func__'):
-            self.called = state.wrapper == monitor.function.__func__
-        else:
-            self.called = state.wrapper == monitor.function
+        self.called = True
 
         # inputs/outputs
-        if self.called:
-            self.inputs = state.inargs
-            self.input_kwargs = state.inkwargs
-            self.outputs = state.args
-            self.output_kwargs = state.kwargs
-            self.result = state.result
+        if state.record is not None and monitor.spec_info in state.rv.sharing:
+            # the data is read from the record of the call in the call log,
+            # shared by all specs
+            self._record = state.record
+            self._spec_info = monitor.spec_info
+            self._number = state.record.number
+            self.timestamp = state.record.timestamp
+            return
+        for name, value in _call_values(monitor.spec_info.copy_func, state).items():
+            setattr(self, name, value)
+
+        # an item produced by, or the end of, a monitored generator
+        if 'item' in state or state.end_of_stream:
+            self.item = state.item
+            self.index = state.index
+            self.end_of_stream = bool(state.end_of_stream)
+            self.count = state.count
+            self.aggregates = dict((state.aggregates or {}).get(monitor.spec_info, {}))
+
+    @classmethod
+    def from_record(cls, monitor, record, history):
+        """
+        The data of the call of the function of monitor in record, from the
+        call log history.
+        """
+        self = cls.__new__(cls)
+        self.name = monitor.name
+        self.called = True
+        self._record = record
+        self._spec_info = monitor.spec_info
+        self._history = history
+        self._number = record.number
+        self.timestamp = record.timestamp
+        return self
+
+    def _compact(self):
+        # serializes the data of the call into one string, which is decoded
+        # again when read. data that can't be pickled is kept as is
+        if _slot(self, '_packed') is not None or _slot(self, '_record') is not None:
+            return
+        values = {}
+        for name in _PACKED_FIELDS:
+            value = _slot(self, name, _unset)
+            if value is not _unset:
+                values[name] = value
+        try:
+            self._packed = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        for name in values:
+            delattr(self, name)
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't set, such as the packed ones
+        # or the ones in the record of the call
+        record = _slot(self, '_record')
+        if record is not None and name in _CALL_FIELDS:
+            return record.values(self._spec_info)[name]
+        packed = _slot(self, '_packed')
+        if packed is None or name not in _PACKED_FIELDS:
+            raise AttributeError(name)
+        values = _unpack(self, packed)
+        if name not in values:
+            raise AttributeError(name)
+        return values[name]
 
     def __repr__(self):
         return "FunctionCallData(%s, %s)" % (self.name, self.called)
 
+_CALL_FIELDS = ('inputs', 'input_kwargs', 'outputs', 'output_kwargs', 'result', 'capture_mode')
+
+def _call_values(copy_func, state):
+    # the data of a call, as seen by the specs with the copy function
+    # copy_func. state is the state of the call, or its record
+    values = {}
+    _input_values(values, copy_func, state)
+    _output_values(values, copy_func, state)
+    return values
+
+def _input_values(values, copy_func, state):
+    # the copies of the arguments made with the copy function of the spec, if
+    # they weren't made with the one of the wrapper
+    if (copy_func or instrumentation.copy_func) is instrumentation.NO_COPY_FUNC:
+        values['capture_mode'] = instrumentation.CAPTURE_NONE
+    else:
+        values['capture_mode'] = state.capture_mode or instrumentation.CAPTURE_DEEP
+    if state.incopies and copy_func in state.incopies:
+        values['inputs'], values['input_kwargs'] = state.incopies[copy_func]
+    else:
+        values['inputs'] = state.inargs
+        values['input_kwargs'] = state.inkwargs
+
+def _output_values(values, copy_func, state):
+    # the snapshots of the arguments after the call, which share the copies of
+    # everything left unchanged with the inputs
+    if state.outcopies and copy_func in state.outcopies:
+        values['outputs'], values['output_kwargs'] = state.outcopies[copy_func]
+    elif state.outargs is not None:
+        values['outputs'] = state.outargs
+        values['output_kwargs'] = state.outkwargs
+    else:
+        values['outputs'] = state.args
+        values['output_kwargs'] = state.kwargs
+    values['result'] = state.result
+
+class CallRecord(object):
+    """
+    A call of a monitored function, as kept in its call log. It holds the
+    state of the call once for all specs, which read it through the
+    FunctionCallData of the call.
+    """
+    _STATE = ('args', 'kwargs', 'inargs', 'inkwargs', 'incopies', 'capture_mode',
+            'outargs', 'outkwargs', 'outcopies', 'result')
+    __slots__ = ('timestamp', 'number', '_values') + _STATE
+
+    def __init__(self, timestamp, state):
+        self.timestamp = timestamp
+        self.number = None
+        # the fields of state that aren't set are None
+        self.args = state.args
+        self.kwargs = state.kwargs
+        self.inargs = state.inargs
+        self.inkwargs = state.inkwargs
+        self.incopies = state.incopies
+        self.capture_mode = state.capture_mode
+        self.outargs = self.outkwargs = self.outcopies = self.result = None
+        # the values of the call per copy function, made when first read
+        self._values = {}
+        if state.outargs is not None:
+            self.finish(state)
+
+    def finish(self, state):
+        # the state after the call. the values read before it keep their inputs
+        self.outargs = state.outargs
+        self.outkwargs = state.outkwargs
+        self.outcopies = state.outcopies
+        self.result = state.result
+        for copy_func, values in self._values.items():
+            _output_values(values, copy_func, self)
+
+    def values(self, spec_info):
+        copy_func = spec_info.copy_func
+        values = self._values.get(copy_func)
+        if values is None:
+            values = self._values[copy_func] = _call_values(copy_func, self)
+        return values
+
+    def __repr__(self):
+        return "CallRecord(%s)" % self.number
+
+_PACKED_FIELDS = ('inputs', 'input_kwargs', 'outputs', 'output_kwargs', 'result', 'item')
+_SIZED_FIELDS = _PACKED_FIELDS + ('_packed', 'aggregates')
+
+# the last decoded call of each history, since specs tend to read several
+# values of one call. the cache goes with the history; it holds the packed
+# data, and not the call, which refers to the history
+_unpacked = weakref.WeakKeyDictionary()
+_unpacked_lock = threading.Lock()
+
+def _unpack(call_data, packed):
+    history = _slot(call_data, '_history')
+    if history is None:
+        return pickle.loads(packed)
+    with _unpacked_lock:
+        last, values = _unpacked.get(history, (None, None))
+    if last is not packed:
+        values = pickle.loads(packed)
+        with _unpacked_lock:
+            _unpacked[history] = (packed, values)
+    return values
+
 
 ##################################################################
 ### objects with logic
 ##################################################################
 
 class Event(object):
+    __slots__ = ('_spec_function', '_spec_info', '_should_call_spec', '_event_data',
+            'fn', 'called_function')
+
     def __init__(self, spec_function, spec_info, event_data):
         self._spec_function = spec_function
         self._spec_info = spec_info
         self._should_call_spec = spec_info.active
+        self._event_data = event_data
 
-        self.history = spec_info.history
-        self.prev = event_data.prev
+        calls = tuple(FunctionCallEvent(spec_info.monitors[func_data.name], func_data)
+                for func_data in event_data.fn._calls)
+        self.called_function = calls[0]
+        self.fn = EventFunctions(spec_info, calls)
 
-        self.fn = EventFunctions(spec_info, event_data.fn)
-        self.called_function = self.fn._called
+    @property
+    def history(self):
+        return self._spec_info.history
+
+    @property
+    def seq(self):
+        return self._event_data.seq
+
+    @property
+    def timestamp(self):
+        return self._event_data.timestamp
+
+    @property
+    def prev(self):
+        return self._event_data.prev
 
     def next(self, next_function):
-        self._spec_info.oneshots.append(next_function)
+        _add_oneshot(self._spec_info, self._spec_info, next_function)
 
     def next_called_should_be(self, monitor, error_msg=None):
         name_to_check = monitor.name
@@ -332,40 +1057,75 @@ class Event(object):
         return "Event(%s)" % (self.fn)
 
 class EventFunctions(object):
-    def __init__(self, spec_info, event_data_functions):
-        self._functions = []
-        for name, monitor in spec_info.monitors.items():
-            function_call_data = event_data_functions[name]
-            fe = FunctionCallEvent(monitor, function_call_data)
-            self._functions.append(fe)
-            self.__dict__[name] = fe
-            if fe.called:
-                self._called = fe
+    """
+    The monitored functions in an event, by name. The functions that weren't
+    called are the not_called events of their monitors.
+    """
+    __slots__ = ('_spec_info', '_calls')
+
+    def __init__(self, spec_info, calls):
+        self._spec_info = spec_info
+        self._calls = calls
+
+    def __getattr__(self, name):
+        calls = _slot(self, '_calls')
+        if calls is not None:
+            for called in calls:
+                if name == called.name:
+                    return called
+            monitor = self._spec_info.monitors.get(name)
+            if monitor is not None:
+                return monitor.not_called
+        raise AttributeError(name)
 
     def __getitem__(self, name):
-        return self.__dict__[name]
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    @property
+    def _functions(self):
+        return [self[name] for name in self._spec_info.monitor_names]
 
     def __repr__(self):
         return "EventFunctions(%s)" % self._functions
 
+# the data of a call, as seen by specs. it is read from the FunctionCallData of
+# the call when it is first accessed
+_EVENT_FIELDS = ('inputs', 'input_kwargs', 'outputs', 'output_kwargs', 'result',
+        'capture_mode', 'timestamp', 'item', 'index', 'end_of_stream', 'count', 'aggregates')
+
 class FunctionCallEvent(object):
+    __slots__ = ('monitor', '_function_call_data') + _EVENT_FIELDS
+
     def __init__(self, monitor, function_call_data):
         self.monitor = monitor
+        self._function_call_data = function_call_data
+
+    @property
+    def name(self):
+        return self._function_call_data.name
 
-        self.history = monitor.history
-        if hasattr(function_call_data, 'prev'):
-            self.prev = function_call_data.prev
-
-        # copy data from function_call_data
-        self.name = function_call_data.name
-        self.called = function_call_data.called
-        if function_call_data.called:
-            # TODO: make it possible for this to work when not called. how?
-            self.inputs = function_call_data.inputs
-            self.input_kwargs = function_call_data.input_kwargs
-            self.outputs = function_call_data.outputs
-            self.output_kwargs = function_call_data.output_kwargs
-            self.result = function_call_data.result
+    @property
+    def called(self):
+        return self._function_call_data.called
+
+    @property
+    def history(self):
+        return self.monitor.history
+
+    @property
+    def prev(self):
+        return self._function_call_data.prev
+
+    def __getattr__(self, name):
+        data = _slot(self, '_function_call_data')
+        if data is None or not data.called or name not in _EVENT_FIELDS:
+            raise AttributeError(name)
+        value = getattr(data, name)
+        setattr(self, name, value)
+        return value
 
     def next(self, func, func_args=None, func_kwargs=None):
         func_args = func_args or tuple()
@@ -374,7 +1134,7 @@ class FunctionCallEvent(object):
         def on_next_call(monitors):
             func(monitors, *func_args, **func_kwargs)
 
-        self.monitor.oneshots.append(on_next_call)
+        _add_oneshot(self.monitor.spec_info, self.monitor, on_next_call)
 
     def __repr__(self):
         return "FunctionCallEvent(%s, %s)" % (self.name, self.called)
@@ -415,11 +1175,81 @@ def configure(**options):
     global _error_handler, _enable_copy_args
     _error_handler = options.get('error_handler', DEFAULT_ERROR_HANDLER)
     _enable_copy_args = options.get('enable_copy_args', True)
-    instrumentation.copy_func = instrumentation.DEEP_COPY_FUNC if _enable_copy_args else instrumentation.NO_COPY_FUNC
+    instrumentation.copy_func = instrumentation.REGISTRY_COPY_FUNC if _enable_copy_args else instrumentation.NO_COPY_FUNC
+
+    copy_budget = (options.get('copy_budget', None),
+            options.get('rolling_copy_budget', None),
+            options.get('rolling_copy_window', 100))
+    if copy_budget != _get_copy_budget():
+        instrumentation.set_copy_budget(*copy_budget)
+
+def _get_copy_budget():
+    return (instrumentation.copy_budget, instrumentation.rolling_copy_budget,
+            instrumentation.rolling_copy_window)
+
+class CopyBudgetExceeded(RuntimeWarning):
+    pass
+
+def _report_capture_downgrade(func, old_mode, new_mode, message):
+    _error_handler.handle(WARNING, [CopyBudgetExceeded(message)])
+
+instrumentation.on_capture_downgrade = _report_capture_downgrade
+
+def register_copier(cls, fn):
+    """
+    Registers fn as the function copying the arguments of monitored functions
+    that are instances of cls, instead of deepcopy. See
+    instrumentation.register_copier.
+    """
+    instrumentation.register_copier(cls, fn)
+
+def stats():
+    """
+    Returns the number of bytes retained by the history of every spec, and of
+    each of its monitors, as estimated from their entries:
+
+        {spec: {'retained_bytes': n, 'monitors': {name: n}}}
+
+    The events in the history of a spec hold the calls in the histories of its
+    monitors, and the figure of the spec includes them, so the figures overlap
+    and shouldn't be added up. Calls that are kept once in the call log of
+    their function, for several specs, are only counted for the monitors.
+    Histories local to threads are the ones of the calling thread.
+    """
+    result = {}
+    for spec in list(_specs):
+        spec_info = spec._prv.spec_info
+        with _lock_for(spec_info):
+            # the histories of monitors whose functions haven't been imported
+            # yet are empty, and not made here
+            monitors = dict((name, monitor.history.retained_bytes() if monitor.function else 0)
+                    for name, monitor in spec_info.monitors.items())
+            result[spec] = {
+                    'retained_bytes': spec_info.history.retained_bytes(),
+                    'monitors': monitors
+                }
+    return result
+
+def disable():
+    """
+    Disables all monitoring, by swapping all instrumented functions for the
+    original ones. The specifications are kept, and can be enabled again.
+    """
+    instrumentation.disable()
+
+def enable():
+    """
+    Enables all monitoring disabled through disable.
+    """
+    instrumentation.enable()
 
 def get_configuration():
     global _error_handler, _enable_copy_args
+    copy_budget, rolling_copy_budget, rolling_copy_window = _get_copy_budget()
     return {
             'error_handler': _error_handler,
-            'enable_copy_args': _enable_copy_args
+            'enable_copy_args': _enable_copy_args,
+            'copy_budget': copy_budget,
+            'rolling_copy_budget': rolling_copy_budget,
+            'rolling_copy_window': rolling_copy_window
         }
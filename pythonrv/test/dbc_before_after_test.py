@@ -25,6 +25,9 @@ def func_spike(x):
 def func_zorro(x):
     return "zorro"
 
+def func_xander(x):
+    return x
+
 def func_attributes():
     return func_attributes.test_attrib
 func_attributes.test_attrib = "test"
@@ -141,6 +144,26 @@ class TestOnFunctions(unittest.TestCase):
             func_zorro('n')
         self.assertEquals(e.exception.message, 'n')
 
+    def test_wrapper_rebuilt_in_place(self):
+        calls = []
+
+        @dbc.before(func_xander)
+        def p(x):
+            calls.append('p%d' % x)
+
+        wrapper = func_xander
+        self.assertEquals(func_xander(1), 1)
+
+        @dbc.after(func_xander)
+        @dbc.use_state(inargs=True)
+        def q(state):
+            calls.append('q%d' % state.inargs[0])
+
+        # adding conditions rebuilds the wrapper, but references to it stay valid
+        self.assertTrue(wrapper is func_xander)
+        self.assertEquals(wrapper(2), 2)
+        self.assertEquals(calls, ['p1', 'p2', 'q2'])
+
     def test_calling_cond_alone(self):
         class Aloha:
             def m(self, x):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import unittest
+import math
 
 from pythonrv import dbc
 
@@ -188,3 +189,202 @@ class TestState(unittest.TestCase):
         for i in range(20):
             m()
             n()
+
+    def test_recursion(self):
+        @dbc.use_state(inargs = True)
+        def q(state):
+            n, = state.inargs
+            assert state.args[0] == n
+            assert state.result == math.factorial(n)
+
+        @dbc.contract(post=q)
+        def fact(n):
+            if n < 2:
+                return 1
+            return n * fact(n-1)
+
+        assert fact(6) == 720
+
+    def test_exception_does_not_leak_state(self):
+        @dbc.use_state()
+        def p(state):
+            assert 'result' not in state
+            if state.args[0] == 'raise':
+                raise ValueError("buffy")
+
+        @dbc.use_state()
+        def q(state):
+            assert state.args[0] == 'ok'
+
+        @dbc.contract(pre=p, post=q)
+        def m(x):
+            return x
+
+        with self.assertRaises(ValueError):
+            m('raise')
+        assert m('ok') == 'ok'
+
+    def test_global_store(self):
+        @dbc.use_state(global_store = True)
+        def p(state):
+            state.global_store['calls'] = state.global_store.get('calls', 0) + 1
+            assert state.global_store['calls'] == state.args[0]
+
+        @dbc.contract(pre=p)
+        def m(i):
+            pass
+
+        for i in range(1, 5):
+            m(i)
+
+    def test_generator(self):
+        seen = []
+
+        @dbc.use_state()
+        def q(state):
+            if state.end_of_stream:
+                assert 'item' not in state
+                seen.append(('end', state.count))
+            else:
+                seen.append((state.index, state.item))
+
+        @dbc.contract(post=q)
+        def m(n):
+            for i in range(n):
+                yield -i
+
+        assert list(m(2)) == [0, -1]
+        assert seen == [(0, 0), (1, -1), ('end', 2)]
+        assert list(m(0)) == []
+        assert seen[-1] == ('end', 0)
+
+    def test_capture(self):
+        class Game(object):
+            def __init__(self):
+                self.board = [0, 0]
+                self.log = ['start']
+
+        @dbc.use_state(inargs=True, capture={'inputs': ['0.board', 'y']})
+        def q(state):
+            game = state.inargs[0]
+            assert game.board == [0, 0]
+            assert not hasattr(game, 'log')
+            assert state.inargs[1] is None
+            assert state.inkwargs == {'y': 3}
+
+        @dbc.contract(post=q)
+        def m(game, x, y=None):
+            game.board[0] = x
+            game.log.append('move')
+
+        m(Game(), 1, y=3)
+        m(Game(), 1, y=3)
+
+    def test_capture_merged_over_conditions(self):
+        @dbc.use_state(inargs=True, capture={'inputs': ['0.a']})
+        def p(state):
+            assert state.inargs[0] == {'a': 1, 'b': 2}
+
+        @dbc.use_state(inargs=True)
+        def q(state):
+            assert state.inargs[0] == {'a': 1, 'b': 2}
+
+        @dbc.contract(pre=(p, q))
+        def m(x):
+            pass
+
+        m({'a': 1, 'b': 2})
+
+    def test_invalid_capture(self):
+        with self.assertRaises(ValueError) as e:
+            dbc.use_state(inargs=True, capture={'in': ['0']})
+        self.assertEquals(e.exception.message, "Unknown capture keys in")
+
+    def test_outargs_share_unchanged_copies(self):
+        class Game(object):
+            def __init__(self):
+                self.board = [0, 0]
+                self.players = ['a', 'b']
+
+        @dbc.use_state(inargs=True, outargs=True)
+        def q(state):
+            ingame, inrules = state.inargs
+            outgame, outrules = state.outargs
+            assert ingame.board == [0, 0]
+            assert outgame.board == [1, 0]
+            assert outgame is not ingame
+            assert outgame.players is ingame.players
+            assert outrules is inrules
+            assert state.outkwargs['log'] is not state.inkwargs['log']
+
+        @dbc.contract(post=q)
+        def m(game, rules, log):
+            game.board[0] = 1
+            log.append('move')
+
+        m(Game(), {'size': [2]}, log=[])
+
+    def test_outargs_slots_compared(self):
+        class Piece(object):
+            __slots__ = ('pos',)
+            def __init__(self):
+                self.pos = 0
+
+        class Pawn(Piece):
+            pass
+
+        class Board(object):
+            __slots__ = ('cells',)
+            def __init__(self):
+                self.cells = [0, 0]
+            def __eq__(self, other):
+                # only compares the number of cells
+                return len(self.cells) == len(other.cells)
+
+        @dbc.use_state(inargs=True, outargs=True)
+        def q(state):
+            pawn, board = state.outargs
+            assert state.inargs[0].pos == 0
+            assert pawn.pos == 5
+            assert state.inargs[1].cells == [0, 0]
+            assert board.cells == [1, 0]
+
+        @dbc.contract(post=q)
+        def m(pawn, board):
+            pawn.pos = 5
+            board.cells = [1, 0]
+
+        m(Pawn(), Board())
+
+    def test_outargs_unchanged_slots_shared(self):
+        class Point(object):
+            __slots__ = ('x', 'y')
+            def __init__(self):
+                self.x = [1]
+                self.y = [2]
+
+        @dbc.use_state(inargs=True, outargs=True)
+        def q(state):
+            assert state.outargs[0] is not state.inargs[0]
+            assert state.outargs[0].x == [3]
+            assert state.outargs[0].y is state.inargs[0].y
+
+        @dbc.contract(post=q)
+        def m(point):
+            point.x = [3]
+
+        m(Point())
+
+    def test_outargs_cycles_not_shared(self):
+        @dbc.use_state(inargs=True, outargs=True)
+        def q(state):
+            assert state.outargs[0] is not state.inargs[0]
+            assert state.outargs[0][0] is state.outargs[0]
+
+        @dbc.contract(post=q)
+        def m(x):
+            pass
+
+        x = []
+        x.append(x)
+        m(x)
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+
+from pythonrv.history import History, HistoryWindow, ColumnarHistory, DiskHistory, estimate_size
+
+class TestHistory(unittest.TestCase):
+    def test_append_and_evict(self):
+        h = History(3)
+        evicted = [h.append(i) for i in range(5)]
+        self.assertEquals(evicted, [[], [], [], [0], [1]])
+        self.assertEquals(len(h), 3)
+        self.assertEquals(list(h), [2, 3, 4])
+        self.assertEquals(list(reversed(h)), [4, 3, 2])
+
+    def test_indexing(self):
+        h = History(3)
+        for i in range(4):
+            h.append(i)
+        self.assertEquals(h[0], 1)
+        self.assertEquals(h[-1], 3)
+        self.assertEquals(h[-3], 1)
+        self.assertEquals(h[1:], [2, 3])
+        with self.assertRaises(IndexError):
+            h[3]
+        with self.assertRaises(IndexError):
+            h[-4]
+
+    def test_infinite(self):
+        h = History()
+        for i in range(1000):
+            self.assertEquals(h.append(i), [])
+        self.assertEquals(len(h), 1000)
+        self.assertEquals(h[0], 0)
+
+    def test_entry(self):
+        h = History(2)
+        for i in range(3):
+            h.append('e%d' % i)
+        self.assertEquals(h.appended, 3)
+        self.assertEquals(h.entry(0), None)
+        self.assertEquals(h.entry(1), 'e1')
+        self.assertEquals(h.entry(2), 'e2')
+        self.assertEquals(h.entry(3), None)
+
+    def test_clear(self):
+        h = History(2)
+        for i in range(3):
+            h.append(i)
+        h.clear()
+        self.assertEquals(list(h), [])
+        h.append(7)
+        self.assertEquals(list(h), [7])
+
+    def test_window(self):
+        h = History(window=10)
+        self.assertEquals(h.append('a', 0), [])
+        self.assertEquals(h.append('b', 5), [])
+        self.assertEquals(h.append('c', 10), [])
+        self.assertEquals(h.append('d', 12), ['a'])
+        self.assertEquals(h.append('e', 30), ['b', 'c', 'd'])
+        self.assertEquals(list(h), ['e'])
+        self.assertEquals(h.timestamp(-1), 30)
+        self.assertEquals(h.entry(3), None)
+        self.assertEquals(h.entry(4), 'e')
+
+    def test_window_and_capacity(self):
+        h = History(2, window=10)
+        for i in range(5):
+            h.append(i, i)
+        self.assertEquals(list(h), [3, 4])
+        h.append(5, 14)
+        self.assertEquals(list(h), [4, 5])
+        h.append(6, 25)
+        self.assertEquals(list(h), [6])
+
+    def test_grows_after_eviction(self):
+        h = History(window=2)
+        for i in range(3):
+            h.append(i, i)
+        # wraps around the evicted slots, and then grows
+        for i in range(3, 10):
+            h.append(i, 3)
+        self.assertEquals(list(h), range(1, 10))
+        self.assertEquals(h[0], 1)
+        self.assertEquals(h[-1], 9)
+
+    def test_invalid_capacity(self):
+        with self.assertRaises(ValueError) as e:
+            History(0)
+        self.assertEquals(e.exception.message, "The capacity of a history must be at least 1, not 0")
+
+        with self.assertRaises(ValueError) as e:
+            History(window=0)
+        self.assertEquals(e.exception.message, "The window of a history must be positive, not 0")
+
+    def test_resize(self):
+        h = History(2)
+        for i in range(3):
+            h.append(i)
+        self.assertEquals(h.resize(4), [])
+        for i in range(3, 5):
+            h.append(i)
+        self.assertEquals(list(h), [1, 2, 3, 4])
+        self.assertEquals(h.resize(1), [1, 2, 3])
+        self.assertEquals(h.append(5), [4])
+        self.assertEquals(list(h), [5])
+
+    def test_max_bytes(self):
+        h = History(max_bytes=10, sizeof=len)
+        self.assertEquals([h.append(e) for e in ['aaaa', 'bbbb', 'cc']], [[], [], []])
+        self.assertEquals(h.retained_bytes(), 10)
+        self.assertEquals(h.append('ddd'), ['aaaa'])
+        self.assertEquals(h.append('eeeeeeeeeeee'), ['bbbb', 'cc', 'ddd'])
+        # the newest entry is kept, even if it is too large
+        self.assertEquals(list(h), ['eeeeeeeeeeee'])
+        self.assertEquals(h.retained_bytes(), 12)
+
+    def test_retained_bytes(self):
+        h = History(sizeof=len)
+        for e in ['a', 'bb', 'ccc']:
+            h.append(e)
+        self.assertEquals(h.retained_bytes(), 6)
+
+    def test_invalid_max_bytes(self):
+        with self.assertRaises(ValueError) as e:
+            History(max_bytes=0)
+        self.assertEquals(e.exception.message, "The byte budget of a history must be positive, not 0")
+
+class TestEstimateSize(unittest.TestCase):
+    def test_containers(self):
+        small = estimate_size([1])
+        assert estimate_size([range(1000)]) > small + 1000
+        assert estimate_size({'x': range(1000)}) > small + 1000
+
+    def test_shared_objects_counted_once(self):
+        x = range(1000)
+        assert estimate_size([x, x]) < estimate_size([x, list(x)])
+
+    def test_instances(self):
+        class A(object):
+            def __init__(self):
+                self.values = range(1000)
+        assert estimate_size(A()) > estimate_size(range(1000))
+
+class TestHistoryWindow(unittest.TestCase):
+    def test_window(self):
+        h = History(5)
+        h.append(0)
+        w = HistoryWindow(h, 2, start=h.appended, wrap=lambda entry: -entry)
+        self.assertEquals(len(w), 0)
+        h.append(1)
+        self.assertEquals(list(w), [-1])
+        for i in range(2, 5):
+            h.append(i)
+        self.assertEquals(len(w), 2)
+        self.assertEquals(list(w), [-3, -4])
+        self.assertEquals(list(reversed(w)), [-4, -3])
+        self.assertEquals(w[0], -3)
+        self.assertEquals(w[-1], -4)
+        self.assertEquals(w.entry(4), -4)
+        self.assertEquals(w.entry(2), None)
+        with self.assertRaises(IndexError):
+            w[2]
+
+    def test_window_larger_than_history(self):
+        h = History(2)
+        w = HistoryWindow(h)
+        for i in range(4):
+            h.append(i)
+        self.assertEquals(list(w), [2, 3])
+
+class TestColumnarHistory(unittest.TestCase):
+    def test_columns(self):
+        h = ColumnarHistory({'x': lambda e: e[0], 'y': lambda e: e[1]}, capacity=3)
+        for i in range(5):
+            h.append((i, 10 - i))
+        self.assertEquals(len(h), 3)
+        self.assertEquals(list(h.column('x')), [2, 3, 4])
+        self.assertEquals(h.column('x').max(), 4)
+        self.assertEquals(h.column('y').min(), 6)
+        self.assertEquals(h.column('x').sum(), 9)
+        self.assertEquals(h.column('x').mean(), 3)
+        assert h.column('x').is_sorted()
+        assert not h.column('y').is_sorted()
+        self.assertEquals(h[-1].x, 4)
+        self.assertEquals(h.entry(2).y, 8)
+        self.assertEquals(h.entry(1), None)
+        with self.assertRaises(ValueError) as e:
+            h.column('z')
+        self.assertEquals(e.exception.message, "The history has no column z")
+
+    def test_none_is_nan(self):
+        h = ColumnarHistory({'x': lambda e: e})
+        h.append(None)
+        value = h[0].x
+        assert value != value
+
+    def test_bad_values_are_nan(self):
+        h = ColumnarHistory({'x': lambda e: e[0], 'y': lambda e: e[1]})
+        h.append(('abc', 1))
+        h.append((2, [3]))
+        h.append((4, 5))
+        x, y = h.column('x'), h.column('y')
+        self.assertEquals(len(x), 3)
+        self.assertEquals(len(y), 3)
+        assert x[0] != x[0]
+        assert y[1] != y[1]
+        self.assertEquals((x[2], y[2]), (4, 5))
+
+    def test_failing_column(self):
+        h = ColumnarHistory({'x': lambda e: e['x'], 'y': lambda e: e['y']})
+        h.append({'x': 1, 'y': 2})
+        with self.assertRaises(KeyError):
+            h.append({'x': 3})
+        # the columns are still aligned
+        self.assertEquals(len(h), 1)
+        h.append({'x': 4, 'y': 5})
+        self.assertEquals(list(h.column('x')), [1, 4])
+        self.assertEquals(list(h.column('y')), [2, 5])
+
+    def test_many_evictions(self):
+        h = ColumnarHistory({'x': lambda e: e}, capacity=10)
+        for i in range(5000):
+            h.append(i)
+        self.assertEquals(list(h.column('x')), range(4990, 5000))
+        assert len(h._times) < 5000
+
+    def test_window(self):
+        h = ColumnarHistory({'x': lambda e: e}, window=5)
+        for i in range(10):
+            h.append(i, timestamp=i)
+        self.assertEquals(list(h.column('x')), [4, 5, 6, 7, 8, 9])
+
+class TestSortedIndex(unittest.TestCase):
+    def test_queries(self):
+        h = History(index=lambda e: e[0])
+        for e in [(5, 'a'), (1, 'b'), (3, 'c'), (5, 'd'), (8, 'e')]:
+            h.append(e)
+        self.assertEquals(h.nearest_below(5), (3, 'c'))
+        self.assertEquals(h.nearest_below(6), (5, 'd'))
+        self.assertEquals(h.nearest_below(1), None)
+        self.assertEquals(h.nearest_above(3), (5, 'a'))
+        self.assertEquals(h.nearest_above(8), None)
+        self.assertEquals(h.range(2, 5), [(3, 'c'), (5, 'a'), (5, 'd')])
+        self.assertEquals(h.range(9, 10), [])
+
+    def test_eviction(self):
+        h = History(2, index=lambda e: e)
+        for e in [3, 1, 2]:
+            h.append(e)
+        self.assertEquals(h.range(0, 10), [1, 2])
+        self.assertEquals(h.nearest_below(10), 2)
+        h.clear()
+        self.assertEquals(h.range(0, 10), [])
+
+    def test_ordered_keys(self):
+        h = History(3, index=lambda e: e)
+        for e in range(1000):
+            h.append(e)
+            self.assertEquals(h.nearest_below(e), e - 1 if e else None)
+        # the evicted keys don't pile up
+        self.assertTrue(len(h.index._sorted) <= 6)
+        self.assertEquals(h.range(0, 1000), [997, 998, 999])
+        h.append(500)
+        h.append(501)
+        self.assertEquals(h.range(0, 1000), [500, 501, 999])
+        self.assertEquals(h.nearest_above(501), 999)
+        self.assertEquals(h.nearest_below(500), None)
+
+    def test_failing_key(self):
+        def index(e):
+            if e is None:
+                raise ValueError("no key")
+            return e
+
+        h = History(2, index=index)
+        h.append(1)
+        with self.assertRaises(ValueError) as e:
+            h.append(None)
+        self.assertEquals(e.exception.message, "no key")
+        # the history is left as it was
+        self.assertEquals(list(h), [1])
+        self.assertEquals(h.appended, 1)
+        for e in [3, 2]:
+            h.append(e)
+        self.assertEquals(list(h), [3, 2])
+        self.assertEquals(h.range(0, 10), [2, 3])
+
+    def test_no_index(self):
+        with self.assertRaises(ValueError) as e:
+            History().range(1, 2)
+        self.assertEquals(e.exception.message, "The history has no index")
+
+class TestHashIndex(unittest.TestCase):
+    def test_lookup(self):
+        h = History(3, key=lambda e: e[0])
+        for e in [('a', 1), ('b', 2), ('a', 3)]:
+            h.append(e)
+        self.assertEquals(h.lookup('a'), ('a', 3))
+        self.assertEquals(h.lookup('b'), ('b', 2))
+        self.assertEquals(h.lookup('c'), None)
+        self.assertEquals(h.lookup('a', skip=1), ('a', 1))
+        self.assertEquals(h.lookup('a', skip=2), None)
+
+        h.append(('c', 4))
+        h.append(('c', 5))
+        # ('b', 2) has been evicted
+        self.assertEquals(h.lookup('b'), None)
+        self.assertEquals(h.lookup('c'), ('c', 5))
+        h.append(('d', 6))
+        self.assertEquals(h.lookup('a'), None)
+        self.assertEquals(h.key_index._numbers.keys(), ['c', 'd'])
+
+    def test_unhashable_key(self):
+        h = History(2, index=lambda e: e[1], key=lambda e: e[0])
+        h.append(('a', 1))
+        with self.assertRaises(TypeError):
+            h.append(([], 2))
+        # the history still works
+        self.assertEquals(list(h), [('a', 1)])
+        h.append(('b', 3))
+        h.append(('a', 4))
+        self.assertEquals(list(h), [('b', 3), ('a', 4)])
+        self.assertEquals(h.lookup('a'), ('a', 4))
+        self.assertEquals(h.lookup('a', skip=1), None)
+        self.assertEquals(sorted(h.key_index._numbers.keys()), ['a', 'b'])
+        self.assertEquals(h.range(0, 10), [('b', 3), ('a', 4)])
+
+    def test_no_key(self):
+        with self.assertRaises(ValueError) as e:
+            History().lookup(1)
+        self.assertEquals(e.exception.message, "The history has no key")
+
+class TestDiskHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_spill_to_disk(self):
+        h = DiskHistory(self.path, hot_size=2)
+        for i in range(5):
+            self.assertEquals(h.append({'i': i}), [])
+        self.assertEquals(len(h), 5)
+        self.assertEquals(h._disk_count, 3)
+        self.assertEquals([e['i'] for e in h], range(5))
+        self.assertEquals([e['i'] for e in reversed(h)], range(4, -1, -1))
+        self.assertEquals(h[1], {'i': 1})
+        self.assertEquals(h[-1], {'i': 4})
+        self.assertEquals(h.entry(0), {'i': 0})
+
+    def test_capacity_and_window(self):
+        h = DiskHistory(self.path, hot_size=1, capacity=3, window=10)
+        for i in range(5):
+            h.append(i, i)
+        self.assertEquals(list(h), [2, 3, 4])
+        self.assertEquals(h.append(5, 13.5), [2, 3])
+        self.assertEquals(list(h), [4, 5])
+        self.assertEquals(h.timestamp(0), 4)
+        self.assertEquals(h.entry(3), None)
+
+    def test_index(self):
+        h = DiskHistory(self.path, hot_size=1, capacity=3, index=lambda e: -e)
+        for i in range(5):
+            h.append(i)
+        self.assertEquals(h.range(-10, 0), [4, 3, 2])
+        self.assertEquals(h.nearest_below(-3), 4)
+
+    def test_failing_index(self):
+        h = DiskHistory(self.path, hot_size=1, capacity=2, index=lambda e: -e)
+        h.append(1)
+        with self.assertRaises(TypeError):
+            h.append('a')
+        for i in range(2, 5):
+            h.append(i)
+        self.assertEquals(list(h), [3, 4])
+        self.assertEquals(h.range(-10, 0), [4, 3])
+
+    def test_unpicklable(self):
+        h = DiskHistory(self.path, hot_size=1)
+        f = lambda: 'x'
+        h.append(f)
+        h.append(1)
+        self.assertTrue(h[0] is f)
+
+    def test_loaded(self):
+        loaded = []
+        h = DiskHistory(self.path, hot_size=1, loaded=lambda e, history: loaded.append((e, history)))
+        h.append('a')
+        h.append('b')
+        self.assertEquals(h[0], 'a')
+        self.assertEquals(loaded, [('a', h)])
+
+    def test_shared_file(self):
+        a = DiskHistory(self.path, hot_size=1)
+        b = DiskHistory(self.path, hot_size=1)
+        for i in range(3):
+            a.append(i)
+            b.append(-i)
+        self.assertEquals(list(a), [0, 1, 2])
+        self.assertEquals(list(b), [0, -1, -2])
+
+    def test_processes(self):
+        h = DiskHistory(self.path, hot_size=1)
+        for i in range(3):
+            h.append(i)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # the child continues with a copy of the history, and its own
+                # histories in the same file
+                other = DiskHistory(self.path, hot_size=1)
+                for i in range(10, 15):
+                    h.append(i)
+                    other.append(i)
+                if list(h) == [0, 1, 2] + range(10, 15) and list(other) == range(10, 15):
+                    status = 0
+                # freeing the copy leaves the table of the parent
+                del h
+            finally:
+                os._exit(status)
+        mine = DiskHistory(self.path, hot_size=1)
+        for i in range(20, 25):
+            h.append(i)
+            mine.append(i)
+        self.assertEquals(os.waitpid(pid, 0)[1], 0)
+        h.append(25)
+        self.assertEquals(list(h), [0, 1, 2] + range(20, 26))
+        self.assertEquals(list(mine), range(20, 25))
+
+    def test_failing_file(self):
+        h = DiskHistory(os.path.join(self.dir, 'missing', 'history.db'), hot_size=1)
+        for i in range(3):
+            h.append(i)
+        self.assertEquals(list(h), [0, 1, 2])
+
+        h = DiskHistory(self.path, hot_size=1)
+        h.append('a')
+        h._db.execute("DROP TABLE %s" % h._table)
+        h.append('b')
+        h.append('c')
+        self.assertEquals(list(h), ['a', 'b', 'c'])
+        self.assertEquals(h._in_memory, {0: 'a', 1: 'b'})
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# this module is only imported by the tests for monitoring through dotted paths
+
+def f(x):
+    return x
+
+class M(object):
+    def m(self):
+        return 'm'
+
+    @classmethod
+    def c(cls):
+        return 'c'
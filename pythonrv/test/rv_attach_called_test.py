@@ -352,3 +352,121 @@ class TestOnObject(unittest.TestCase):
         self.assertEquals(e.exception.message, "m called on d")
         self.assertEquals(b.m(), 'm')
         self.assertEquals(M().m(), 'm')
+
+class TestDottedPath(unittest.TestCase):
+    def test_lazy_import(self):
+        import sys
+        module_name = 'pythonrv.test.lazy_monitoree'
+        self.assertFalse(module_name in sys.modules)
+
+        @rv.monitor(f=module_name + ':f', m=module_name + ':M.m')
+        def spec(event):
+            raise ValueError("%s called" % event.called_function.name)
+
+        self.assertFalse(module_name in sys.modules)
+
+        # references taken through from-imports are monitored as well
+        from pythonrv.test.lazy_monitoree import f, M
+
+        with self.assertRaises(ValueError) as e:
+            f(1)
+        self.assertEquals(e.exception.message, "f called")
+
+        with self.assertRaises(ValueError) as e:
+            M().m()
+        self.assertEquals(e.exception.message, "m called")
+
+        # the module is already imported; the function is monitored directly
+        @rv.monitor(c=module_name + ':M.c')
+        def spec2(event):
+            raise ValueError("c called")
+
+        with self.assertRaises(ValueError) as e:
+            M.c()
+        self.assertEquals(e.exception.message, "c called")
+
+    def test_invalid_path(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.monitor(f='pythonrv.test.rv_attach_called_test.t_one')
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message,
+                "Dotted path pythonrv.test.rv_attach_called_test.t_one must be of the form module:attribute")
+
+class TestNotCalled(unittest.TestCase):
+    def test_shared_not_called(self):
+        class M(object):
+            def m(self):
+                pass
+
+            def n(self):
+                pass
+
+        events = []
+        @rv.monitor(m=M.m, n=M.n)
+        def spec(event):
+            events.append(event)
+
+        a = M()
+        a.m()
+        a.m()
+        a.n()
+        first, second, third = events
+        self.assertTrue(first.fn.m.called)
+        self.assertFalse(first.fn.n.called)
+        # the functions that weren't called are shared between events
+        self.assertTrue(first.fn.n is second.fn.n)
+        self.assertTrue(first._event_data.fn.n is second._event_data.fn.n)
+        self.assertEquals(first.fn['n'].name, 'n')
+        self.assertFalse(hasattr(first.fn.n, 'inputs'))
+        self.assertEquals(first.fn.n.prev, None)
+        with self.assertRaises(AttributeError):
+            first._event_data.fn.n.name = 'm'
+        with self.assertRaises(AttributeError):
+            first.fn.o
+        with self.assertRaises(KeyError):
+            first.fn['o']
+        # but not next calls
+        first.fn.n.next(lambda event: None)
+        self.assertEquals(len(spec._prv.spec_info.monitors['n'].oneshots), 1)
+
+    def test_one_function_two_names(self):
+        class M(object):
+            def m(self, x):
+                return x
+
+        events = []
+        @rv.monitor(a=M.m, b=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            events.append(event)
+
+        M().m(1)
+        M().m(2)
+        self.assertEquals(len(events), 2)
+        event = events[-1]
+        self.assertTrue(event.fn.a.called)
+        self.assertTrue(event.fn.b.called)
+        self.assertEquals((event.fn.a.result, event.fn.b.result), (2, 2))
+        self.assertEquals(event.fn.a.prev.result, 1)
+        self.assertEquals(len(event.fn.b.history), 2)
+
+        # a wrapper whose monitors aren't set up is skipped, rather than
+        # failing the call
+        spec._prv.spec_info.monitors_by_wrapper.clear()
+        self.assertEquals(M().m(3), 3)
+        self.assertEquals(len(events), 2)
+
+    def test_no_instance_dicts(self):
+        class M(object):
+            def m(self, x):
+                return x
+
+        @rv.monitor(m=M.m)
+        def spec(event):
+            self.assertFalse(hasattr(event, '__dict__'))
+            self.assertFalse(hasattr(event.fn.m, '__dict__'))
+            self.assertFalse(hasattr(event.history[-1], '__dict__'))
+            self.assertEquals(event.fn.m.inputs[1], 1)
+
+        M().m(1)
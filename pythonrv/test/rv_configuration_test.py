@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import unittest
 import logging
+import time
+import gc
+import weakref
 
 from mock_and_helpers import TestLogging
-from pythonrv import rv
+from pythonrv import rv, instrumentation
 
 error_levels = [rv.DEBUG, rv.INFO, rv.WARNING, rv.ERROR, rv.CRITICAL]
 
@@ -77,6 +80,28 @@ class TestConfiguration(unittest.TestCase):
             b.m()
         self.assertEquals(e.exception.message, "buffy")
 
+    def test_copy_args_per_spec(self):
+        class M(object):
+            def m(self):
+                self.x = 123
+
+        seen = []
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec_copy(event):
+            seen.append(('copy', hasattr(event.fn.m.inputs[0], 'x')))
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST, enable_copy_args=False)
+        def spec_no_copy(event):
+            seen.append(('no copy', hasattr(event.fn.m.inputs[0], 'x')))
+
+        a = M()
+        a.m()
+        self.assertEquals(seen, [('copy', False), ('no copy', True)])
+        self.assertEquals(M.m._prv.copy_funcs, (instrumentation.NO_COPY_FUNC,))
+
     def test_cannot_copy_cstringio(self):
         import cStringIO, copy
         cs = cStringIO.StringIO()
@@ -199,3 +224,302 @@ class TestSpecErrorLevels(TestLogging):
             a.m()
             self.assertLog(t, "of time")
 
+
+class TestCopiers(unittest.TestCase):
+    def tearDown(self):
+        instrumentation._copiers.clear()
+        instrumentation._dispatch.clear()
+
+    def test_immutables_not_copied(self):
+        big = 'x' * 1000
+        t = (1, big, None)
+        self.assertTrue(instrumentation.registry_copy(big) is big)
+        self.assertTrue(instrumentation.registry_copy(t) is t)
+
+    def test_containers_copied(self):
+        shared = [1]
+        value = {'a': shared, 'b': shared, 'c': (shared,), 'd': bytearray('ab')}
+        c = instrumentation.registry_copy(value)
+        self.assertEquals(c, value)
+        self.assertFalse(c['a'] is shared)
+        self.assertTrue(c['a'] is c['b'])
+        self.assertTrue(c['c'][0] is c['a'])
+        self.assertFalse(c['d'] is value['d'])
+
+    def test_register_copier(self):
+        class Board(object):
+            def __init__(self, cells):
+                self.cells = cells
+        class SubBoard(Board):
+            pass
+
+        copied = []
+        def copy_board(board):
+            copied.append(board)
+            return Board(list(board.cells))
+        rv.register_copier(Board, copy_board)
+
+        class M(object):
+            def m(self, board):
+                board.cells[0] = 1
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            raise ValueError("%s %s" % (event.fn.m.inputs[1].cells, event.fn.m.outputs[1].cells))
+
+        board = SubBoard([0, 0])
+        with self.assertRaises(ValueError) as e:
+            M().m(board)
+        self.assertEquals(e.exception.message, "[0, 0] [1, 0]")
+        # once for the inputs, once for the outputs
+        self.assertEquals(copied, [board, board])
+
+    def test_register_copier_nested(self):
+        class Board(object):
+            def __init__(self, cells):
+                self.cells = cells
+        class Game(object):
+            def __init__(self, board):
+                self.board = board
+                self.moves = [board]
+
+        copied = []
+        def copy_board(board):
+            copied.append(board)
+            return Board(list(board.cells))
+        rv.register_copier(Board, copy_board)
+
+        game = Game(Board([0, 0]))
+        c = instrumentation.registry_copy(game)
+        self.assertEquals(copied, [game.board])
+        self.assertFalse(c is game)
+        self.assertEquals(c.board.cells, [0, 0])
+        self.assertTrue(c.moves[0] is c.board)
+        game.board.cells[0] = 1
+        self.assertEquals(c.board.cells, [0, 0])
+
+    def test_set_elements_copied(self):
+        class Cell(object):
+            def __init__(self, value):
+                self.value = value
+        cell = Cell(0)
+        value = {'s': set([cell]), 'f': frozenset([cell]), 'i': frozenset([1, 2])}
+        c = instrumentation.registry_copy(value)
+        self.assertTrue(c['i'] is value['i'])
+        self.assertFalse(c['f'] is value['f'])
+        cell.value = 1
+        self.assertEquals([e.value for e in c['s']], [0])
+        self.assertEquals([e.value for e in c['f']], [0])
+        self.assertTrue(list(c['s'])[0] is list(c['f'])[0])
+
+    def test_register_invalid_copier(self):
+        with self.assertRaises(ValueError) as e:
+            rv.register_copier(3, lambda x: x)
+        self.assertEquals(e.exception.message, "Copiers can only be registered for types, not 3")
+
+        with self.assertRaises(ValueError) as e:
+            rv.register_copier(list, None)
+        self.assertEquals(e.exception.message, "The copier for list must be callable")
+
+class CollectingErrorHandler(object):
+    def __init__(self):
+        self.errors = []
+
+    def handle(self, level, errors):
+        self.errors += [(level, e) for e in errors]
+
+class Slow(object):
+    def __init__(self, copied):
+        self.copied = copied
+
+def copy_slow(slow):
+    time.sleep(0.01)
+    return Slow(True)
+
+class TestCopyBudget(unittest.TestCase):
+    def setUp(self):
+        self.config = rv.get_configuration()
+        rv.register_copier(Slow, copy_slow)
+
+    def tearDown(self):
+        rv.configure(**self.config)
+        instrumentation._copiers.clear()
+        instrumentation._dispatch.clear()
+
+    def monitored(self):
+        class M(object):
+            def m(self, slow):
+                pass
+
+        modes = []
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            modes.append((event.fn.m.capture_mode, event.fn.m.inputs[1].copied))
+        return M, modes
+
+    def test_per_call_budget(self):
+        handler = CollectingErrorHandler()
+        rv.configure(error_handler=handler, copy_budget=0.005)
+        M, modes = self.monitored()
+
+        for i in range(4):
+            M().m(Slow(False))
+        self.assertEquals(modes, [('deep', True)] + [('shallow', False)] * 3)
+
+        self.assertEquals(len(handler.errors), 1)
+        level, e = handler.errors[0]
+        self.assertEquals(level, rv.WARNING)
+        self.assertTrue(isinstance(e, rv.CopyBudgetExceeded))
+        self.assertTrue('downgraded from deep to shallow copies' in str(e))
+
+    def test_rolling_budget(self):
+        handler = CollectingErrorHandler()
+        rv.configure(error_handler=handler, rolling_copy_budget=0.05, rolling_copy_window=5)
+        M, modes = self.monitored()
+
+        for i in range(4):
+            M().m(Slow(False))
+        self.assertEquals(modes, [('deep', True)] * 3 + [('shallow', False)])
+        self.assertEquals(len(handler.errors), 1)
+
+    def test_no_budget(self):
+        M, modes = self.monitored()
+        M().m(Slow(False))
+        self.assertEquals(modes, [('deep', True)])
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError) as e:
+            rv.configure(rolling_copy_budget=1, rolling_copy_window=0)
+        self.assertEquals(e.exception.message, "The copy budget window must be at least one call, not 0")
+
+class TestEnableDisable(unittest.TestCase):
+    def tearDown(self):
+        rv.enable()
+
+    def test_disable_enable(self):
+        class M(object):
+            def m(self):
+                return 'm'
+
+        original = M.__dict__['m']
+
+        @rv.monitor(m=M.m)
+        def spec(event):
+            raise ValueError("buffy")
+
+        a = M()
+        with self.assertRaises(ValueError) as e:
+            a.m()
+        self.assertEquals(e.exception.message, "buffy")
+
+        rv.disable()
+        self.assertTrue(M.__dict__['m'] is original)
+        self.assertEquals(a.m(), 'm')
+
+        rv.enable()
+        self.assertFalse(M.__dict__['m'] is original)
+        with self.assertRaises(ValueError) as e:
+            a.m()
+        self.assertEquals(e.exception.message, "buffy")
+
+    def test_disable_contract(self):
+        from pythonrv import dbc
+
+        def p(x):
+            raise ValueError("willow")
+
+        @dbc.contract(pre=p)
+        def m(x):
+            return x
+
+        rv.disable()
+        self.assertEquals(m(3), 3)
+
+        rv.enable()
+        with self.assertRaises(ValueError) as e:
+            m(3)
+        self.assertEquals(e.exception.message, "willow")
+
+    def test_monitor_while_disabled(self):
+        class M(object):
+            def m(self):
+                return 'm'
+
+        rv.disable()
+
+        @rv.monitor(m=M.m)
+        def spec(event):
+            raise ValueError("buffy")
+
+        self.assertEquals(M().m(), 'm')
+
+        rv.enable()
+        with self.assertRaises(ValueError) as e:
+            M().m()
+        self.assertEquals(e.exception.message, "buffy")
+
+    def test_registry(self):
+        from pythonrv import instrumentation
+
+        class M(object):
+            def m(self):
+                pass
+
+        @rv.monitor(m=M.m)
+        def spec(event):
+            pass
+
+        entries = [_prv for _prv in instrumentation.registry() if _prv.container is M]
+        self.assertEquals(len(entries), 1)
+        self.assertEquals(entries[0].name, 'm')
+        self.assertTrue(entries[0].attached)
+
+    def test_registry_doesnt_keep_instances(self):
+        class M(object):
+            def m(self):
+                pass
+
+        a = M()
+        instrumentation.instrument(a, a.m, pre=lambda self: None)
+        ref = weakref.ref(a)
+        self.assertEquals(sum(1 for _prv in instrumentation.registry() if _prv.container is ref()), 1)
+        key = (id(a), 'm')
+        del a
+        gc.collect()
+        self.assertEquals(ref(), None)
+        self.assertFalse(key in instrumentation._registry)
+
+class TestPhases(unittest.TestCase):
+    def test_empty_phases_skipped(self):
+        class M(object):
+            def m(self, x):
+                pass
+
+        @rv.monitor(m=M.m)
+        def pre_spec(event):
+            pass
+
+        _prv = M.m._prv
+        self.assertEquals(_prv.rv.pre_specs, (pre_spec,))
+        self.assertEquals(_prv.rv.post_specs, ())
+        self.assertEquals(_prv.pre, [rv.pre_func_call])
+        self.assertEquals(_prv.post, [])
+        # nothing is copied after the call
+        self.assertFalse(_prv.use_state.outargs)
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def post_spec(event):
+            event.success()
+
+        self.assertEquals(_prv.rv.post_specs, (post_spec,))
+        self.assertEquals(_prv.post, [rv.post_func_call])
+        self.assertTrue(_prv.use_state.outargs)
+
+        # the post spec finishes, and its phase is left out again
+        M().m(1)
+        self.assertEquals(_prv.rv.post_specs, ())
+        self.assertEquals(_prv.post, [])
+        self.assertEquals(_prv.pre, [rv.pre_func_call])
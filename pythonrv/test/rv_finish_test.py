@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 
-from pythonrv import rv
+from pythonrv import rv, dbc
 
 class TestSuccessAndFailure(unittest.TestCase):
     def test_success_removes_spec(self):
@@ -102,8 +102,9 @@ class TestSuccessAndFailure(unittest.TestCase):
             event.next(after)
             event.finish()
 
-        self.assertEquals(len(M.m._prv.rv.specs), 1)
-        self.assertEquals(len(M.n._prv.rv.specs), 1)
+        m, n = M.m, M.n
+        self.assertEquals(len(m._prv.rv.specs), 1)
+        self.assertEquals(len(n._prv.rv.specs), 1)
 
         def after(event):
             event.fn.n.next(after2)
@@ -118,8 +119,8 @@ class TestSuccessAndFailure(unittest.TestCase):
             a.m()
         self.assertEquals(e.exception.message, "spike")
 
-        self.assertEquals(len(M.m._prv.rv.specs), 1)
-        self.assertEquals(len(M.n._prv.rv.specs), 1)
+        self.assertEquals(len(m._prv.rv.specs), 1)
+        self.assertEquals(len(n._prv.rv.specs), 1)
 
         a.m()
         a.m()
@@ -130,8 +131,11 @@ class TestSuccessAndFailure(unittest.TestCase):
         self.assertEquals(e.exception.message, "hacket")
 
 
-        self.assertEquals(len(M.m._prv.rv.specs), 0)
-        self.assertEquals(len(M.n._prv.rv.specs), 0)
+        self.assertEquals(len(m._prv.rv.specs), 0)
+        self.assertEquals(len(n._prv.rv.specs), 0)
+        # the original functions have been restored
+        self.assertFalse(hasattr(M.m, '_prv'))
+        self.assertFalse(hasattr(M.n, '_prv'))
 
         a.n()
         a.m()
@@ -170,3 +174,74 @@ class TestSuccessAndFailure(unittest.TestCase):
         self.assertEquals(">1212122", a.calls)
         a.n()
         self.assertEquals(">12121222", a.calls)
+
+class TestRelease(unittest.TestCase):
+    def test_release_and_reinstall(self):
+        class M(object):
+            def m(self):
+                return 'm'
+
+        original = M.__dict__['m']
+
+        @rv.monitor(m=M.m)
+        def spec(event):
+            event.success()
+            raise ValueError("first time only")
+
+        wrapper = M.__dict__['m']
+        self.assertFalse(wrapper is original)
+
+        a = M()
+        with self.assertRaises(ValueError) as e:
+            a.m()
+        self.assertEquals(e.exception.message, "first time only")
+        self.assertEquals(a.m(), 'm')
+        self.assertTrue(M.__dict__['m'] is original)
+        self.assertEquals(a.m(), 'm')
+
+        @rv.monitor(m=M.m)
+        def spec2(event):
+            raise ValueError("spec2")
+
+        # the same wrapper is installed again
+        self.assertTrue(M.__dict__['m'] is wrapper)
+        with self.assertRaises(ValueError) as e:
+            a.m()
+        self.assertEquals(e.exception.message, "spec2")
+
+    def test_release_on_instance(self):
+        class M(object):
+            def m(self):
+                return 'm'
+
+        a = M()
+
+        @rv.monitor(m=a.m)
+        def spec(event):
+            event.failure("once")
+
+        self.assertTrue('m' in a.__dict__)
+        with self.assertRaises(AssertionError) as e:
+            a.m()
+        self.assertEquals(e.exception.message, "once")
+        self.assertFalse('m' in a.__dict__)
+        self.assertEquals(a.m(), 'm')
+
+    def test_release_keeps_dbc_conditions(self):
+        class M(object):
+            def m(self):
+                return 'm'
+
+        calls = []
+        dbc.before(M, 'm')(lambda self: calls.append('p'))
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            event.success()
+
+        a = M()
+        a.m()
+        a.m()
+        self.assertEquals(calls, ['p', 'p'])
+        self.assertEquals(len(M.m._prv.rv.specs), 0)
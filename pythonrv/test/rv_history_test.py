@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 import unittest
+import threading
+import time
+import os
+import shutil
+import tempfile
 
 from pythonrv import rv
 
@@ -192,3 +197,596 @@ class TestHistory(unittest.TestCase):
             a.m(i)
             a.n(i)
             a.o(i)
+
+class TestHistoryScope(unittest.TestCase):
+    def run_in_threads(self, target, num_threads=4):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_thread_scope(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        errors = []
+        @rv.monitor(m=M.m)
+        @rv.spec(history_size=rv.INFINITE_HISTORY_SIZE, history_scope=rv.THREAD_SCOPE)
+        def spec(event):
+            # only calls from the same thread are in the history
+            inputs = [e.fn.m.inputs[1] for e in event.history]
+            if len(set(inputs)) != 1:
+                errors.append(inputs)
+
+        a = M()
+        def calls(i):
+            for j in range(50):
+                a.m(i)
+        self.run_in_threads(calls)
+        self.assertEquals(errors, [])
+
+    def test_global_scope(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        @rv.monitor(m=M.m)
+        @rv.spec(history_size=rv.INFINITE_HISTORY_SIZE, history_scope=rv.GLOBAL_SCOPE)
+        def spec(event):
+            event.next(lambda e: None)
+
+        a = M()
+        def calls(i):
+            for j in range(50):
+                a.m(i)
+        self.run_in_threads(calls)
+
+        history = spec._prv.spec_info.history
+        self.assertEquals(len(history), 200)
+        seqs = [e.seq for e in history]
+        self.assertEquals(seqs, sorted(seqs))
+
+    def test_global_scope_call_log(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        errors = []
+        @rv.monitor(m=M.m)
+        @rv.spec(history_size=3)
+        def spec(event):
+            # other threads evict calls from the shared call log while the
+            # history is read
+            history = event.fn.m.history
+            calls = list(history) + list(reversed(history)) + history[:] + [history[0], history[-1]]
+            if None in calls or len(calls) > 14:
+                errors.append(calls)
+
+        @rv.monitor(m=M.m)
+        @rv.spec(history_size=5)
+        def other_spec(event):
+            pass
+
+        a = M()
+        def calls(i):
+            for j in range(200):
+                a.m(i)
+        self.run_in_threads(calls)
+        self.assertEquals(errors, [])
+
+    def test_invalid_scope(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_scope='process')
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "Unknown history scope process")
+
+class TestPrev(unittest.TestCase):
+    def test_prev_of_evicted(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        events = []
+        @rv.monitor(m=M.m)
+        @rv.spec(history_size=3)
+        def spec(event):
+            events.append(event)
+
+        a = M()
+        for i in range(5):
+            a.m(i)
+
+        # the events that are still in the history link to each other
+        self.assertEquals(events[4].prev.fn.m.inputs[1], 3)
+        self.assertEquals(events[4].prev.prev.fn.m.inputs[1], 2)
+        self.assertEquals(events[4].fn.m.prev.prev.inputs[1], 2)
+        # but not to the evicted ones, even though they are still referenced
+        self.assertEquals(events[4].prev.prev.prev, None)
+        self.assertEquals(events[2].prev, None)
+        self.assertEquals(events[1].fn.m.prev, None)
+
+class TestCallLog(unittest.TestCase):
+    def test_shared_between_specs(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x * 2
+
+        events = []
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=2)
+        def spec_a(event):
+            events.append(event)
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=4)
+        def spec_b(event):
+            events.append(event)
+
+        for i in range(5):
+            M.f(i)
+
+        # every call is logged once, for both specs
+        log = M.f._prv.rv.logs[rv.POST]
+        self.assertEquals(len(log), 4)
+        a, b = events[-2:]
+        self.assertEquals([call.inputs[0] for call in a.fn.f.history], [3, 4])
+        self.assertEquals([call.inputs[0] for call in b.fn.f.history], [1, 2, 3, 4])
+        self.assertEquals([call.result for call in b.fn.f.history], [2, 4, 6, 8])
+        assert a.fn.f.history[-1]._record is b.fn.f.history[-1]._record
+        self.assertEquals(b.fn.f.prev.inputs[0], 3)
+        self.assertEquals(a.fn.f.prev.prev, None)
+
+    def test_post_calls_in_order_of_results(self):
+        class M(object):
+            @staticmethod
+            def fact(n):
+                return 1 if n <= 1 else n * M.fact(n - 1)
+
+        events = []
+        @rv.monitor(fact=(M, M.fact))
+        @rv.spec(when=rv.POST, history_size=3)
+        def spec(event):
+            events.append(event)
+
+        @rv.monitor(fact=(M, M.fact))
+        @rv.spec(when=rv.POST)
+        def other_spec(event):
+            pass
+
+        @rv.monitor(fact=(M, M.fact))
+        def pre_spec(event):
+            pass
+
+        M.fact(3)
+        # the recursive calls finish first
+        self.assertEquals([(call.inputs[0], call.result) for call in events[-1].fn.fact.history],
+                [(1, 1), (2, 2), (3, 6)])
+        self.assertEquals(events[1].fn.fact.prev.result, 1)
+
+    def test_single_spec_not_logged(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                pass
+
+        @rv.monitor(f=(M, M.f))
+        def spec(event):
+            raise ValueError(type(event.fn.f.history).__name__)
+
+        with self.assertRaises(ValueError) as e:
+            M.f(1)
+        self.assertEquals(e.exception.message, "History")
+        self.assertEquals(len(M.f._prv.rv.logs[rv.PRE]), 0)
+
+    def test_log_emptied(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                pass
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(history_size=5)
+        def spec(event):
+            pass
+
+        @rv.monitor(f=(M, M.f))
+        def finishing_spec(event):
+            if event.fn.f.inputs[0] == 2:
+                event.success()
+
+        for i in range(3):
+            M.f(i)
+        # the remaining spec keeps its calls, but no longer shares them
+        log = M.f._prv.rv.logs[rv.PRE]
+        self.assertEquals(len(log), 0)
+        M.f(3)
+        history = spec._prv.spec_info.monitors['f'].history
+        self.assertEquals([call.inputs[0] for call in history], [0, 1, 2, 3])
+        self.assertEquals(history[-1].prev.inputs[0], 2)
+        self.assertEquals(len(log), 0)
+
+    def test_copy_policies(self):
+        class M(object):
+            @staticmethod
+            def f(board):
+                board['x'] += 1
+
+        events = []
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST)
+        def copying(event):
+            events.append(event)
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, enable_copy_args=False)
+        def not_copying(event):
+            events.append(event)
+
+        board = {'x': 0}
+        M.f(board)
+        copying_event, not_copying_event = events
+        self.assertEquals(copying_event.fn.f.inputs[0], {'x': 0})
+        assert not_copying_event.fn.f.inputs[0] is board
+
+    def test_not_shared(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                pass
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(index=lambda call: call.inputs[0])
+        def spec(event):
+            raise ValueError(type(event.fn.f.history).__name__)
+
+        with self.assertRaises(ValueError) as e:
+            M.f(1)
+        self.assertEquals(e.exception.message, "History")
+
+class TestHistoryBytes(unittest.TestCase):
+    def test_max_bytes(self):
+        class M(object):
+            @staticmethod
+            def f(data):
+                return len(data)
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(history_max_bytes=100000)
+        def spec(event):
+            pass
+
+        for i in range(5):
+            M.f(range(1000))
+        M.f(range(10))
+        history = spec._prv.spec_info.monitors['f'].history
+        # the small call fits along with a few of the large ones
+        assert 1 < len(history) < 5
+        assert history.retained_bytes() <= 100000
+        # the events hold the calls, and are evicted as well
+        assert len(spec._prv.spec_info.history) < 5
+        self.assertEquals(history[-1].inputs[0], range(10))
+
+    def test_stats(self):
+        class M(object):
+            @staticmethod
+            def f(data):
+                pass
+
+            @staticmethod
+            def g():
+                pass
+
+        @rv.monitor(f=(M, M.f), g=(M, M.g))
+        @rv.spec(history_size=3)
+        def spec(event):
+            pass
+
+        @rv.monitor(f=(M, M.f))
+        def other_spec(event):
+            pass
+
+        M.f(range(1000))
+        stats = rv.stats()[spec]
+        assert stats['monitors']['f'] > 1000
+        self.assertEquals(stats['monitors']['g'], 0)
+        # the events refer to the calls in the call log of the functions,
+        # which are counted for the monitors
+        assert 0 < stats['retained_bytes'] < stats['monitors']['f']
+
+    def test_invalid_max_bytes(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_max_bytes=0)
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "History byte budgets must be positive, not 0")
+
+class TestHistoryWindow(unittest.TestCase):
+    def test_window(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        @rv.monitor(m=M.m)
+        @rv.spec(history_window=0.05)
+        def spec(event):
+            raise ValueError([e.fn.m.inputs[1] for e in event.history])
+
+        a = M()
+        for i, expected in enumerate([[0], [0, 1], [0, 1, 2]]):
+            with self.assertRaises(ValueError) as e:
+                a.m(i)
+            self.assertEquals(e.exception.message, expected)
+        time.sleep(0.1)
+        with self.assertRaises(ValueError) as e:
+            a.m(3)
+        self.assertEquals(e.exception.message, [3])
+
+    def test_window_and_size(self):
+        class M(object):
+            def m(self, i):
+                pass
+
+        @rv.monitor(m=M.m)
+        @rv.spec(history_window=10, history_size=2)
+        def spec(event):
+            assert event.timestamp >= event.prev.timestamp if event.prev else True
+            assert event.fn.m.timestamp == event.timestamp
+            raise ValueError(len(event.history))
+
+        a = M()
+        for i in range(3):
+            with self.assertRaises(ValueError) as e:
+                a.m(i)
+        self.assertEquals(e.exception.message, 2)
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_window=-1)
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "History windows must be positive, not -1")
+
+class TestDiskHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_disk_history(self):
+        class M(object):
+            @staticmethod
+            def f(i):
+                return i * 2
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_file=os.path.join(self.dir, 'h.db'), hot_history_size=2)
+        def spec(event):
+            results = [call.result for call in event.fn.f.history]
+            assert results == range(0, len(results) * 2, 2)
+            assert len(event.history) == len(results)
+            if event.fn.f.inputs[0] > 2:
+                assert event.history[0].prev is None
+                assert event.history[1].prev.fn.f.inputs[0] == 0
+                assert event.prev.prev.fn.f.inputs[0] == event.fn.f.inputs[0] - 2
+                # the calls in the events read back from disk have their prev
+                assert event.history[-3].fn.f.prev.inputs[0] == event.fn.f.inputs[0] - 3
+
+        for i in range(10):
+            M.f(i)
+        history = spec._prv.spec_info.history
+        self.assertEquals(len(history), 10)
+        # all but the hot ones were written to disk
+        self.assertEquals(history._disk_count, 8)
+        self.assertEquals(history._in_memory, {})
+
+    def test_invalid_hot_size(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_file=os.path.join(self.dir, 'h.db'), hot_history_size=0)
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "Hot history sizes must be at least 1, not 0")
+
+class TestHistoryIndex(unittest.TestCase):
+    def test_index(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x * x
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=rv.INFINITE_HISTORY_SIZE,
+                index=lambda call: call.inputs[0])
+        def spec(event):
+            x = event.fn.f.inputs[0]
+            below = event.fn.f.history.nearest_below(x)
+            above = event.history.nearest_above(x)
+            raise ValueError("%s %s" % (below and below.result,
+                above and above.fn.f.result))
+
+        for x, expected in [(5, "None None"), (1, "None 25"), (3, "1 25"), (7, "25 None")]:
+            with self.assertRaises(ValueError) as e:
+                M.f(x)
+            self.assertEquals(e.exception.message, expected)
+
+    def test_history_key(self):
+        class Cache(object):
+            def get(self, key):
+                return len(key)
+
+        @rv.monitor(get=Cache.get)
+        @rv.spec(when=rv.POST, history_size=10, history_key=lambda call: call.inputs[1])
+        def spec(event):
+            key = event.fn.get.inputs[1]
+            # the current call is the newest one with its key
+            assert event.fn.get.history.lookup(key) is event.history[-1].fn.get
+            last = event.fn.get.history.lookup(key, skip=1)
+            raise ValueError(last and last.result)
+
+        c = Cache()
+        for key, expected in [('a', None), ('bb', None), ('a', 1), ('ccc', None), ('bb', 2)]:
+            with self.assertRaises(ValueError) as e:
+                c.get(key)
+            self.assertEquals(e.exception.message, expected)
+
+class TestCompactHistory(unittest.TestCase):
+    def test_compact_history(self):
+        class M(object):
+            @staticmethod
+            def f(board, moves=None):
+                board['x'] += 1
+                return [board['x']]
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=5, history_layout=rv.COMPACT_LAYOUT)
+        def spec(event):
+            # the current call isn't packed
+            assert not hasattr(event.fn.f._function_call_data, '_packed')
+            calls = list(event.fn.f.history)
+            for old, new in zip(calls, calls[1:]):
+                assert hasattr(old, '_packed')
+                assert old.outputs[0]['x'] == old.result[0]
+                assert new.inputs[0]['x'] == old.outputs[0]['x']
+                assert old.input_kwargs == {'moves': [1, 2]}
+
+        board = {'x': 0}
+        for i in range(10):
+            M.f(board, moves=[1, 2])
+
+    def test_compact_byte_budget(self):
+        class M(object):
+            @staticmethod
+            def f(data):
+                pass
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(history_layout=rv.COMPACT_LAYOUT, history_max_bytes=200000)
+        def spec(event):
+            pass
+
+        for i in range(20):
+            M.f(range(1000))
+        spec_info = spec._prv.spec_info
+        for history in (spec_info.history, spec_info.monitors['f'].history):
+            # the sizes are the ones of the packed calls
+            self.assertEquals(history.retained_bytes(), sum(history.sizeof(e) for e in history))
+        # so more calls fit than the unpacked ones would allow
+        self.assertEquals(len(spec_info.history), 20)
+
+    def test_unpacked_per_history(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x
+            @staticmethod
+            def g(x):
+                return -x
+
+        @rv.monitor(f=(M, M.f), g=(M, M.g))
+        @rv.spec(when=rv.POST, history_size=5, history_layout=rv.COMPACT_LAYOUT)
+        def spec(event):
+            pass
+
+        for i in range(3):
+            M.f(i)
+            M.g(i)
+        monitors = spec._prv.spec_info.monitors
+        f, g = monitors['f'].history, monitors['g'].history
+        # reading the calls of the two histories in turn
+        values = [(a.inputs[0], b.result, a.result, b.inputs[0]) for a, b in zip(f, g)[:-1]]
+        self.assertEquals(values, [(0, 0, 0, 0), (1, -1, 1, 1)])
+        self.assertTrue(f in rv._unpacked and g in rv._unpacked)
+
+    def test_unpicklable_kept(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(history_layout=rv.COMPACT_LAYOUT)
+        def spec(event):
+            if event.fn.f.prev:
+                raise ValueError(event.fn.f.prev.inputs[0]())
+
+        M.f(lambda: 'a')
+        with self.assertRaises(ValueError) as e:
+            M.f(lambda: 'b')
+        self.assertEquals(e.exception.message, "a")
+
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_layout='rows')
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "Unknown history layout rows")
+
+class TestColumnarHistory(unittest.TestCase):
+    def test_columnar_history(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x * x
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=rv.INFINITE_HISTORY_SIZE,
+                history_layout=rv.COLUMNAR_LAYOUT,
+                columns={'x': lambda call: call.inputs[0], 'result': lambda call: call.result})
+        def spec(event):
+            results = event.fn.f.history.column('result')
+            assert results.is_sorted()
+            assert results.max() == event.fn.f.result
+            assert event.history.column('x').max() == event.fn.f.inputs[0]
+            if event.fn.f.prev:
+                assert event.fn.f.prev.x == event.fn.f.inputs[0] - 1
+
+        for i in range(100):
+            M.f(i)
+        with self.assertRaises(AssertionError):
+            M.f(-1)
+
+    def test_columns_by_name(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=3, history_layout=rv.COLUMNAR_LAYOUT,
+                columns=['result'])
+        def spec(event):
+            raise ValueError(list(event.fn.f.history.column('result')))
+
+        for i in range(4):
+            with self.assertRaises(ValueError) as e:
+                M.f(i)
+        self.assertEquals(e.exception.message, [1, 2, 3])
+
+    def test_columnar_needs_columns(self):
+        with self.assertRaises(ValueError) as e:
+            @rv.spec(history_layout=rv.COLUMNAR_LAYOUT)
+            def spec(event):
+                pass
+        self.assertEquals(e.exception.message, "Columnar histories need columns")
+
+    def test_bad_value(self):
+        class M(object):
+            @staticmethod
+            def f(x):
+                return x
+
+        @rv.monitor(f=(M, M.f))
+        @rv.spec(when=rv.POST, history_size=rv.INFINITE_HISTORY_SIZE,
+                history_layout=rv.COLUMNAR_LAYOUT, columns=['result'])
+        def spec(event):
+            pass
+
+        for x in [1, 'abc', 3]:
+            self.assertEquals(M.f(x), x)
+        results = list(spec._prv.spec_info.monitors['f'].history.column('result'))
+        self.assertEquals(len(results), 3)
+        self.assertEquals(results[::2], [1, 3])
@@ -92,3 +92,144 @@ class TestInputOutput(unittest.TestCase):
         with self.assertRaises(ValueError) as e:
             a.m()
         self.assertEquals(e.exception.message, "m")
+
+class TestGenerators(unittest.TestCase):
+    def test_items(self):
+        class M(object):
+            def m(self, n):
+                for i in range(n):
+                    yield i * 2
+
+        items = []
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            items.append((event.fn.m.index, event.fn.m.item, event.fn.m.end_of_stream))
+
+        self.assertEquals(list(M().m(3)), [0, 2, 4])
+        self.assertEquals(items, [(0, 0, False), (1, 2, False), (2, 4, False)])
+
+    def test_end_of_stream_and_aggregates(self):
+        class M(object):
+            def m(self, n):
+                for i in range(n):
+                    yield i
+
+        ends = []
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST, end_of_stream=True, aggregates={
+            'total': (lambda acc, item: acc + item, 0),
+            'max': (max, -1),
+            })
+        def spec(event):
+            if event.fn.m.end_of_stream:
+                ends.append((event.fn.m.count, event.fn.m.aggregates['total'], event.fn.m.aggregates['max']))
+            else:
+                assert event.fn.m.aggregates['total'] == sum(range(event.fn.m.index + 1))
+
+        a = M()
+        for i in a.m(100):
+            pass
+        self.assertEquals(ends, [(100, sum(range(100)), 99)])
+
+        # the aggregates are per call
+        self.assertEquals(list(a.m(3)), [0, 1, 2])
+        self.assertEquals(ends[-1], (3, 3, 2))
+
+    def test_stream_not_exhausted(self):
+        class M(object):
+            def m(self):
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+
+        ends = []
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST, end_of_stream=True)
+        def spec(event):
+            if event.fn.m.end_of_stream:
+                ends.append(event.fn.m.count)
+
+        for i in M().m():
+            if i == 10:
+                break
+        self.assertEquals(ends, [])
+
+    def test_send(self):
+        class M(object):
+            def m(self):
+                total = 0
+                while True:
+                    x = yield total
+                    total += x
+
+        @rv.monitor(m=M.m)
+        @rv.spec(when=rv.POST)
+        def spec(event):
+            assert event.fn.m.item >= 0, "negative total"
+
+        g = M().m()
+        self.assertEquals(next(g), 0)
+        self.assertEquals(g.send(5), 5)
+        self.assertEquals(g.send(3), 8)
+        with self.assertRaises(AssertionError) as e:
+            g.send(-10)
+        self.assertEquals(e.exception.message, "negative total")
+
+class TestCapture(unittest.TestCase):
+    def test_capture_inputs(self):
+        class Board(object):
+            def __init__(self):
+                self.cells = [0, 0]
+                self.big = object()
+
+            def move(self, i, value=1):
+                self.cells[i] = value
+
+        @rv.monitor(move=Board.move)
+        @rv.spec(when=rv.POST, capture={'inputs': ['0.cells', 'value']})
+        def spec(event):
+            old = event.fn.move.inputs[0]
+            assert not hasattr(old, 'big')
+            assert event.fn.move.inputs[1] is None
+            assert event.fn.move.input_kwargs == {'value': 2}
+            raise ValueError("%s -> %s" % (old.cells, event.fn.move.outputs[0].cells))
+
+        with self.assertRaises(ValueError) as e:
+            Board().move(1, value=2)
+        self.assertEquals(e.exception.message, "[0, 0] -> [0, 2]")
+
+    def test_capture_outputs(self):
+        class Board(object):
+            def __init__(self):
+                self.cells = [0, 0]
+                self.moves = 0
+
+            def move(self, i):
+                self.cells[i] = 1
+                self.moves += 1
+
+        @rv.monitor(move=Board.move)
+        @rv.spec(when=rv.POST, capture={'inputs': ['0.cells'], 'outputs': ['0.moves']})
+        def spec(event):
+            assert not hasattr(event.fn.move.outputs[0], 'cells')
+            raise ValueError("%s %s" % (event.fn.move.inputs[0].cells, event.fn.move.outputs[0].moves))
+
+        with self.assertRaises(ValueError) as e:
+            Board().move(0)
+        self.assertEquals(e.exception.message, "[0, 0] 1")
+
+    def test_capture_nothing(self):
+        class M(object):
+            def m(self, x):
+                pass
+
+        @rv.monitor(m=M.m)
+        @rv.spec(capture={})
+        def spec(event):
+            raise ValueError("%s %s" % (event.fn.m.inputs, event.fn.m.input_kwargs))
+
+        with self.assertRaises(ValueError) as e:
+            M().m(3)
+        self.assertEquals(e.exception.message, "(None, None) {}")